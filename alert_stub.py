@@ -0,0 +1,29 @@
+import json
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+# ================= 告警 Webhook 本地桩 (Alert Webhook Stub) =================
+# 用法：python alert_stub.py [端口]，然后设置 QUANT_ALERT_WEBHOOK=http://127.0.0.1:8765/alerts
+# 收到的告警打印到终端，并追加到 alerts_received.jsonl
+
+class AlertHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        alerts = payload.get("alerts", [])
+        with open("alerts_received.jsonl", "a", encoding="utf-8") as f:
+            for a in alerts:
+                f.write(json.dumps(a, ensure_ascii=False) + "\n")
+                print(f"[{a.get('severity', 'info').upper()}] {a.get('message')}")
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass  # 屏蔽默认的访问日志
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    print(f"Alert stub listening on http://127.0.0.1:{port}/alerts")
+    HTTPServer(("127.0.0.1", port), AlertHandler).serve_forever()
@@ -1,8 +1,14 @@
+import os
+import time
 import streamlit as st
+import altair as alt
 import pandas as pd
-from rag_engine import RagEngine
-import yfinance as yf
-from quant_backend import WatchlistManager, DataEngine, RiskRadar, DeepAnalyzer, NewsEngine, MarketUniverse
+from rag_engine import RagEngine, QaSession, ingest_job, report_job
+from quant_backend import WatchlistManager, DataEngine, RiskRadar, DeepAnalyzer, NewsEngine, MarketUniverse, \
+    FundamentalsSnapshot, ScreenerQuery, PortfolioRisk, HistoryCache, ChartEngine, WatchlistMonitor, \
+    FileAlertSink, WebhookAlertSink, SharedMarketCache, SymbolIndex, FxTable
+from telemetry import metrics
+from jobs import JobManager
 
 
 # ================= 0. 语言配置 (i18n) =================
@@ -18,7 +24,9 @@ TRANSLATIONS = {
         'mode_screener': "🔍 Market Screener",
         'mode_deep': "📊 Deep Dive",
         'mode_pdf': "📑 AI PDF Analyst",
-        'screener_title': "🇺🇸 US Market Core Assets",
+        'mode_risk': "🧮 Portfolio Risk",
+        'risk_title': "🧮 Watchlist Portfolio Risk",
+        'screener_title': "🌏 Cross-Market Core Assets",
         'deep_title': "🔎 Comprehensive Report",
         'pdf_title': "📑 AI Financial Report Generator",
         'pdf_caption': "Upload PDF -> Extract Data -> Generate Report (Auto-Pilot)",
@@ -32,7 +40,13 @@ TRANSLATIONS = {
         'status_ocr': "OCR & Text Cleaning...",
         'status_chunk': "Splitting Data Chunks...",
         'config': "1. Configuration",
-        'report_area': "2. Analysis Result"
+        'report_area': "2. Analysis Result",
+        'job_cancel': "⏹️ Cancel",
+        'job_cancelled': "⏹️ Job cancelled",
+        'job_missing': "⚠️ Job not found (it may have been cleaned up)",
+        'ingest_pending': "⏳ Wait for the PDF to finish indexing",
+        'qa_title': "3. Ask Follow-up Questions",
+        'qa_placeholder': "Ask about this report, e.g. What drove the margin change?"
     },
     '中文': {
         'sidebar_title': "📡 控制台",
@@ -40,7 +54,9 @@ TRANSLATIONS = {
         'mode_screener': "🔍 市场海选 (Screener)",
         'mode_deep': "📊 深度监控 (Deep Dive)",
         'mode_pdf': "📑 AI 财报解读 (PDF Analyst)",
-        'screener_title': "🇺🇸 美股核心海选",
+        'mode_risk': "🧮 组合风险 (Portfolio Risk)",
+        'risk_title': "🧮 关注池组合风险",
+        'screener_title': "🌏 跨市场核心海选",
         'deep_title': "🔎 个股深研报告",
         'pdf_title': "📑 智能财报研报生成器",
         'pdf_caption': "上传财报 -> 自动提取核心数据 -> 生成深度研报 (无需对话)",
@@ -54,7 +70,13 @@ TRANSLATIONS = {
         'status_ocr': "正在进行 OCR 与文本清洗...",
         'status_chunk': "正在切分关键数据块...",
         'config': "1. 配置与上传",
-        'report_area': "2. 分析报告"
+        'report_area': "2. 分析报告",
+        'job_cancel': "⏹️ 取消",
+        'job_cancelled': "⏹️ 任务已取消",
+        'job_missing': "⚠️ 找不到该任务 (可能已被清理)",
+        'ingest_pending': "⏳ 请等待 PDF 入库完成",
+        'qa_title': "3. 追问财报",
+        'qa_placeholder': "针对这份财报提问，例如：毛利率变化的主要原因是什么？"
     }
 }
 
@@ -75,10 +97,123 @@ if 'scan_result' not in st.session_state:
     st.session_state['scan_result'] = None
 
 
-# 缓存雷达数据
+# 跨进程共享行情缓存：多个 app 进程共用一份内存映射的面板 / 快照，只有一个进程去抓上游
+@st.cache_resource
+def get_shared_cache():
+    return SharedMarketCache(ttl=300)
+
+
+# 雷达数据：整个关注池的 6 个月行情一次下载、跨进程共享，单只计算只是几毫秒的向量运算；
+# 结果再在进程内缓存 5 分钟，共享面板取不到时也不会每次重跑都逐只抓取
 @st.cache_data(ttl=300)
-def get_cached_radar(ticker):
-    return RiskRadar.analyze_anomalies(ticker)
+def get_cached_radar(ticker, watchlist):
+    try:
+        close, volume = get_shared_cache().get_panel(watchlist, period="6mo")
+    except Exception:
+        close = volume = None  # 共享缓存取不到时退回逐只抓取 (限流 / 熔断提示由雷达自己给出)
+    hist = None
+    if close is not None and ticker in close.columns:
+        hist = pd.DataFrame({"Close": close[ticker], "Volume": volume[ticker]}).dropna()
+    return RiskRadar.analyze_anomalies(ticker, hist=hist)
+
+
+# 汇率表：跨市场海选时统一换算币种
+@st.cache_resource
+def get_fx_table():
+    return FxTable()
+
+
+# 代码宇宙索引：全市场上市清单只加载、建索引一次
+@st.cache_resource
+def get_symbol_index():
+    return SymbolIndex()
+
+
+# 基本面快照：各进程共用一份内存映射的列式表
+@st.cache_resource
+def get_snapshot():
+    return FundamentalsSnapshot(shared=get_shared_cache())
+
+
+# 本地行情缓存：进程内共享，图表从这里取数
+@st.cache_resource
+def get_history_cache():
+    return HistoryCache()
+
+
+# 关注池变化侦测：告警写入本地文件，配置了 QUANT_ALERT_WEBHOOK 时同时推送
+@st.cache_resource
+def get_monitor():
+    sinks = [FileAlertSink()]
+    if os.environ.get("QUANT_ALERT_WEBHOOK"):
+        sinks.append(WebhookAlertSink(os.environ["QUANT_ALERT_WEBHOOK"]))
+    return WatchlistMonitor(sinks=sinks, history_cache=get_history_cache(), fundamentals=get_snapshot(),
+                            shared=get_shared_cache())
+
+
+# 组合风险：每个关注池组合一份增量协方差状态
+@st.cache_resource
+def get_portfolio_risk(tickers):
+    return PortfolioRisk(window=250)
+
+
+def get_cached_panel(tickers, period="2y"):
+    return get_shared_cache().get_panel(tickers, period=period)
+
+
+# 后台任务：进程内共享一个任务管理器，Embedding 模型也只加载一份
+@st.cache_resource
+def get_job_manager():
+    return JobManager(on_expire=release_job_resources)
+
+
+def release_job_resources(job):
+    """过期的入库任务连同向量库目录一起删除后，已缓存的 RagEngine 也要丢掉"""
+    result = job.get('result')
+    if isinstance(result, dict) and result.get('persist_dir'):
+        get_rag_engine.clear(result['persist_dir'])
+
+
+@st.cache_resource
+def get_embedding_model():
+    return RagEngine.load_embedding_model()
+
+
+# 问答模式：每个已入库的向量库只打开一次，多轮追问、多个会话共用同一个已加载的索引；
+# 同时打开的向量库数量和闲置时间都有上限，任务过期清理时对应条目也会被清掉
+@st.cache_resource(max_entries=8, ttl=3600)
+def get_rag_engine(persist_dir):
+    return RagEngine(persist_dir=persist_dir, embedding_model=get_embedding_model())
+
+
+def show_citations(citations):
+    if citations:
+        st.caption("📎 " + " | ".join(f"[{c['label']}] {QaSession.cite(c)}" for c in citations))
+
+
+def poll_job(job_id, T):
+    """任务进行中时以 fragment 方式每秒刷新进度；结束后触发整页重跑来展示结果"""
+    jm = get_job_manager()
+    job = jm.get(job_id)
+    if job is None or job['status'] in JobManager.FINAL_STATES:
+        st.rerun()
+    st.progress(job['progress'], text=f"{T['processing']} {job['message']}")
+    if st.button(T['job_cancel'], key=f"cancel_{job_id}"):
+        jm.cancel(job_id)
+
+
+def show_job(job_id, T):
+    """渲染任务状态，返回最新的任务记录 (找不到则为 None)"""
+    job = get_job_manager().get(job_id)
+    if job is None:
+        st.warning(T['job_missing'])
+    elif job['status'] in ("queued", "running"):
+        st.fragment(poll_job, run_every=1.0)(job_id, T)
+    elif job['status'] == "failed":
+        st.error(job['error'])
+    elif job['status'] == "cancelled":
+        st.warning(T['job_cancelled'])
+    return job
 
 
 # ================= 2. 侧边栏：核心雷达 =================
@@ -93,9 +228,14 @@ with st.sidebar:
     # 模式切换 (使用字典里的文本)
     app_mode = st.radio(
         T['mode_label'],
-        [T['mode_screener'], T['mode_deep'], T['mode_pdf']]
+        [T['mode_screener'], T['mode_deep'], T['mode_risk'], T['mode_pdf']]
     )
 
+    # 调试面板开关：打开后记录本轮渲染的耗时明细 (关闭时埋点几乎零开销)
+    # 只影响当前会话：勾选后记录本会话这一轮渲染的 span，不改动进程级的采集开关
+    debug_metrics = st.checkbox("🛠️ Debug Metrics", value=False)
+    metrics.begin_render(trace=debug_metrics)
+
 # 2.2 渲染“红绿灯”列表
 watchlist = wm.load()
 selected_ticker = None
@@ -105,7 +245,9 @@ if not watchlist:
 else:
     radar_options = {}
     for ticker in watchlist:
-        data = get_cached_radar(ticker)
+        metrics.incr("cache_lookup", cache="radar")
+        with metrics.span("cache.radar"):
+            data = get_cached_radar(ticker, tuple(watchlist))
 
         # ... (保留原本的 icon 判断代码) ...
         icon = "⚪"
@@ -129,12 +271,32 @@ else:
     if selection:
         selected_ticker = radar_options[selection]
 
+# 2.2b 告警流
+with st.sidebar.expander("🔔 告警 (Alerts)" if lang_opt == '中文' else "🔔 Alerts"):
+    monitor = get_monitor()
+    if st.button("🔄 检查变化" if lang_opt == '中文' else "🔄 Check for changes") and watchlist:
+        with st.spinner("..."):
+            new_alerts, recomputed = monitor.refresh(watchlist)
+        st.caption(f"{len(recomputed)}/{len(watchlist)} recomputed · {len(new_alerts)} new alerts")
+    feed = monitor.sinks[0].recent(15)
+    if feed:
+        for a in feed:
+            icon = {"critical": "🔴", "warning": "🟡"}.get(a["severity"], "🔵")
+            st.markdown(f"{icon} `{a['ts'][5:16]}` {a['message']}")
+    else:
+        st.caption("暂无告警" if lang_opt == '中文' else "No alerts yet")
+
 # 2.3 快速添加/删除
 st.sidebar.markdown("---")
 with st.sidebar.expander("管理关注池" if lang_opt == '中文' else "Manage Watchlist"):
-    new_t = st.text_input("手动添加代码:" if lang_opt == '中文' else "Add Ticker:", placeholder="AAPL").upper()
+    new_t = st.text_input("手动添加代码:" if lang_opt == '中文' else "Add Ticker:", placeholder="AAPL")
     if st.button("添加" if lang_opt == '中文' else "Add"):
-        if wm.add(new_t):
+        symbol = get_symbol_index().validate(new_t)
+        if not symbol:
+            hints = ", ".join(m['symbol'] for m in get_symbol_index().search(new_t, limit=5))
+            st.sidebar.warning(("未知代码" if lang_opt == '中文' else "Unknown symbol")
+                               + (f" — {'是否想找' if lang_opt == '中文' else 'did you mean'}: {hints}" if hints else ""))
+        elif wm.add(symbol):
             st.rerun()
         else:
             st.sidebar.warning("已存在" if lang_opt == '中文' else "Exists")
@@ -148,25 +310,79 @@ with st.sidebar.expander("管理关注池" if lang_opt == '中文' else "Manage
 # 🔴 关键修复：使用 T['mode_screener'] 进行判断
 if app_mode == T['mode_screener']:
     st.title(T['screener_title']) # 使用字典标题
-    st.caption("从 S&P 100 核心资产中，寻找被低估的优质标的。" if lang_opt == '中文' else "Find undervalued assets from S&P 100 core constituents.")
+    st.caption("从美股、港股、澳股、A 股核心资产中，寻找被低估的优质标的。" if lang_opt == '中文' else "Find undervalued assets across US, HK, ASX and A-share core constituents.")
 
     # ================= [新增功能 1] 快速搜索添加 =================
     with st.expander("⚡ 快速添加通道 (直接输入代码)" if lang_opt == '中文' else "⚡ Quick Add (Ticker Symbol)", expanded=False):
         c1, c2 = st.columns([4, 1])
         with c1:
-            quick_ticker = st.text_input("输入股票代码 (如 TSLA)" if lang_opt == '中文' else "Enter Symbol (e.g. TSLA)", placeholder="TSLA",
-                                         label_visibility="collapsed").upper().strip()
+            quick_ticker = st.text_input("输入股票代码或名称 (如 TSLA / 700.HK / Tencent)" if lang_opt == '中文'
+                                         else "Enter symbol or name (e.g. TSLA / 700.HK / Tencent)", placeholder="TSLA",
+                                         label_visibility="collapsed").strip()
         with c2:
-            if st.button("➕ 立即添加" if lang_opt == '中文' else "➕ Add", use_container_width=True):
-                if quick_ticker:
-                    # 调用后端添加逻辑
-                    if wm.add(quick_ticker):
-                        st.toast(f"✅ {quick_ticker} 已加入关注池！", icon="🎉")
-                        st.rerun()  # 强制刷新以更新侧边栏
-                    else:
-                        st.warning(f"⚠️ {quick_ticker} 已存在或无效")
-                else:
-                    st.warning("请输入代码")
+            add_clicked = st.button("➕ 立即添加" if lang_opt == '中文' else "➕ Add", use_container_width=True)
+
+        # 输入即检索 (前缀 + 模糊)，只允许从命中的代码里选择，避免拼错的代码进入关注池。
+        # 输入本身通过校验时排在第一位并默认选中；模糊匹配只做提示，必须手动选中才会添加。
+        # 没有清单文件时，池外的代码只做格式检查，必须勾选确认才能添加
+        index = get_symbol_index()
+        matches = index.search(quick_ticker) if quick_ticker else []
+        typed = index.validate(quick_ticker) if quick_ticker else None
+        if typed and all(m['symbol'] != typed for m in matches):
+            matches = [{"symbol": typed, "name": "输入的代码" if lang_opt == '中文' else "as typed",
+                        "match": "typed"}] + matches
+        choice = None
+        if matches:
+            labels = {f"{m['symbol']} · {m['name']}": m['symbol'] for m in matches}
+            default = None if matches[0]['match'] == "fuzzy" else 0
+            picked = st.selectbox("Matches", list(labels), index=default, label_visibility="collapsed",
+                                  placeholder="你是不是要找…" if lang_opt == '中文' else "Did you mean…")
+            choice = labels[picked] if picked else None
+        elif quick_ticker:
+            st.caption("❓ 没有匹配的代码" if lang_opt == '中文' else "❓ No matching symbol")
+        unverified = index.unverified(quick_ticker) if quick_ticker and not typed else None
+        if unverified and st.checkbox(f"{unverified} 不在已知代码中，仍然添加" if lang_opt == '中文'
+                                      else f"{unverified} is not a known symbol — add it anyway"):
+            choice = unverified
+
+        if add_clicked:
+            if not quick_ticker:
+                st.warning("请输入代码")
+            elif not choice:
+                st.warning(f"⚠️ {quick_ticker} 无效" if lang_opt == '中文' else f"⚠️ {quick_ticker} is not a known symbol")
+                if matches:
+                    st.caption("请从候选中选择一个" if lang_opt == '中文' else "Pick one of the suggestions above")
+            # 调用后端添加逻辑
+            elif wm.add(choice):
+                st.toast(f"✅ {choice} 已加入关注池！", icon="🎉")
+                st.rerun()  # 强制刷新以更新侧边栏
+            else:
+                st.warning(f"⚠️ {choice} 已存在" if lang_opt == '中文' else f"⚠️ {choice} already in watchlist")
+
+    # ================= [新增功能 3] 表达式筛选 (基于本地快照) =================
+    with st.expander("🧮 表达式筛选 (本地快照，毫秒级)" if lang_opt == '中文' else "🧮 Expression Screener (local snapshot)", expanded=False):
+        snapshot = get_snapshot()
+        all_tickers = [t for pool in MarketUniverse.get_market_options().values() for t in pool]
+        if snapshot.refresh_if_stale(all_tickers):  # 超过 max_age 自动在后台刷新，不用等人点按钮
+            st.caption("🔄 Snapshot refreshing in background...")
+        snap_df = snapshot.load()
+        st.caption(f"Snapshot: {len(snap_df)} symbols" + (" (stale)" if snapshot.is_stale() else "")
+                   + " · fields: roe, pe, peg, de, mcap_b, profit_margin, gross_margin, operating_margin")
+        q_where = st.text_input("Where", value="roe > 0.15 and 0 < pe < 40")
+        q_order = st.text_input("Order by", value="-roe")
+        if st.button("🔄 刷新快照" if lang_opt == '中文' else "🔄 Refresh Snapshot"):
+            with st.spinner("Refreshing..."):
+                failed = snapshot.refresh(all_tickers)
+            if failed:
+                st.warning(f"⚠️ {len(failed)} failed: {', '.join(failed)}")
+            snap_df = snapshot.load()
+        try:
+            t0 = time.perf_counter()
+            q_result = ScreenerQuery.run(snap_df, q_where, q_order, limit=200)
+            st.caption(f"⏱️ {len(q_result)} rows in {(time.perf_counter() - t0) * 1000:.1f} ms")
+            st.dataframe(q_result, use_container_width=True, hide_index=True)
+        except ValueError as e:
+            st.error(str(e))
 
     st.markdown("---")
 
@@ -179,18 +395,38 @@ if app_mode == T['mode_screener']:
     with col_pe:
         max_pe = st.number_input("最高 P/E (倍)" if lang_opt == '中文' else "Max P/E", value=40.0, step=1.0)
 
-    # 锁定美股池
-    us_market_key = "🇺🇸 美股市场 (S&P 100核心)"
-    target_pool = MarketUniverse.get_tickers_by_market(us_market_key)
+    # 市场可以任意组合；所有市场共用一条抓取流水线和基本面快照缓存，股价 / 市值统一换算成所选币种
+    market_options = MarketUniverse.get_market_options()
+    col_mkt, col_ccy = st.columns([3, 1])
+    with col_mkt:
+        markets = st.multiselect("市场" if lang_opt == '中文' else "Markets", list(market_options),
+                                 default=[next(iter(market_options))])
+    with col_ccy:
+        currency = st.selectbox("计价币种" if lang_opt == '中文' else "Currency", ["USD", "HKD", "AUD", "CNY"])
+    target_pool = list(dict.fromkeys(t for m in markets for t in market_options[m]))
 
-    st.markdown(f"ℹ️ *当前锁定扫描 {len(target_pool)} 只 S&P 100 核心成分股*" if lang_opt == '中文' else f"ℹ️ *Scanning {len(target_pool)} S&P 100 constituents*")
+    st.markdown(f"ℹ️ *将扫描 {len(markets)} 个市场共 {len(target_pool)} 只核心成分股*" if lang_opt == '中文' else f"ℹ️ *Scanning {len(target_pool)} constituents across {len(markets)} market(s)*")
 
-    if st.button("🚀 开始扫描" if lang_opt == '中文' else "🚀 Start Scan", type="primary", use_container_width=True):
+    if st.button("🚀 开始扫描" if lang_opt == '中文' else "🚀 Start Scan", type="primary", use_container_width=True,
+                 disabled=not target_pool):
         progress_text = "AI 正在连接交易所读取财报..." if lang_opt == '中文' else "AI is fetching financial data..."
         my_bar = st.progress(0, text=progress_text)
-        df = DataEngine.run_screener(target_pool, min_roe=min_roe, max_pe=max_pe)
+        fx = get_fx_table()
+        if fx.is_stale():
+            try:
+                fx.refresh()
+            except Exception:
+                metrics.incr("errors", source="fx")  # 刷新失败就沿用上次 (或内置) 汇率
+        df = DataEngine.run_screener(target_pool, min_roe=min_roe, max_pe=max_pe, currency=currency, fx=fx,
+                                     cache=get_snapshot(), max_age=6 * 3600, stale_ok=True)
         st.session_state['scan_result'] = df
         my_bar.progress(100, text="扫描完成！" if lang_opt == '中文' else "Scan Complete!")
+        failed = df.attrs.get('failed', [])
+        if failed:
+            st.warning(f"⚠️ {len(failed)} 只股票抓取失败 (可能被限流): {', '.join(failed)}" if lang_opt == '中文'
+                       else f"⚠️ {len(failed)} tickers failed to fetch (possibly throttled): {', '.join(failed)}")
+        if not fx.asof:
+            st.caption("ℹ️ 汇率使用内置近似值" if lang_opt == '中文' else "ℹ️ Using built-in approximate FX rates")
 
     # ================= [新增功能 2] 结果精选添加 =================
     if st.session_state['scan_result'] is not None:
@@ -200,14 +436,16 @@ if app_mode == T['mode_screener']:
             st.success(f"🎯 命中 {len(df_result)} 只符合策略的股票" if lang_opt == '中文' else f"🎯 Found {len(df_result)} matching stocks")
 
             # 显示结果表格
+            ccy = df_result.attrs.get('currency') or 'USD'
             st.dataframe(
-                df_result[['symbol', 'name', 'price', 'pe', 'roe_pct', 'market_cap_b']],
+                df_result[['symbol', 'name', 'currency', 'price', 'price_fx', 'pe', 'roe_pct', 'market_cap_b']],
                 column_config={
-                    "symbol": "Code", "name": "Name",
-                    "price": st.column_config.NumberColumn("Price", format="$%.2f"),
+                    "symbol": "Code", "name": "Name", "currency": "Ccy",
+                    "price": st.column_config.NumberColumn("Price (local)", format="%.2f"),
+                    "price_fx": st.column_config.NumberColumn(f"Price ({ccy})", format="%.2f"),
                     "pe": st.column_config.NumberColumn("P/E", format="%.1f"),
                     "roe_pct": st.column_config.NumberColumn("ROE", format="%.1f%%"),
-                    "market_cap_b": st.column_config.NumberColumn("Mkt Cap (B)", format="$%.1fB"),
+                    "market_cap_b": st.column_config.NumberColumn(f"Mkt Cap ({ccy} B)", format="%.1fB"),
                 },
                 use_container_width=True,
                 hide_index=True
@@ -248,7 +486,7 @@ elif app_mode == T['mode_deep']:
         report = DeepAnalyzer.get_comprehensive_report(selected_ticker)
         risk = report['risk']
         base = report['base']
-        metrics = report.get('metrics', {})
+        score_metrics = report.get('metrics', {})
 
         # 2. 标题区
         st.header(f"{T['deep_title']}: {base['symbol']} - {base['name']}")
@@ -263,20 +501,20 @@ elif app_mode == T['mode_deep']:
         m1, m2, m3, m4 = st.columns(4)
 
         # RSI
-        rsi_val = metrics.get('rsi', 50)
+        rsi_val = score_metrics.get('rsi', 50)
         m1.metric("RSI", f"{rsi_val:.1f}", help="<30 Oversold, >70 Overbought")
 
         # PEG
-        peg_val = metrics.get('peg')
+        peg_val = score_metrics.get('peg')
         peg_display = f"{peg_val:.2f}" if peg_val else "N/A"
         m2.metric("PEG", peg_display, help="<1.0 Undervalued")
 
         # 净利率
-        margin_val = metrics.get('profit_margin', 0)
+        margin_val = score_metrics.get('profit_margin', 0)
         m3.metric("Profit Margin", f"{margin_val:.1f}%")
 
         # Sigma
-        sigma_val = risk['data'].get('sigma', 0)
+        sigma_val = risk.get('data', {}).get('sigma', 0)
         m4.metric("Sigma", f"{sigma_val}σ", help=">3.0 Extreme Anomaly")
 
         st.markdown("---")
@@ -339,7 +577,8 @@ elif app_mode == T['mode_deep']:
         st.markdown("---")
         st.subheader("📰 " + ("AI News Sentiment" if lang_opt == 'English' else "AI 舆情顾问"))
 
-        news_data = NewsEngine.get_sentiment_analysis(selected_ticker)
+        with metrics.span("deep_dive.news"):
+            news_data = NewsEngine.get_sentiment_analysis(selected_ticker)
 
         col_s1, col_s2 = st.columns([1, 3])
         with col_s1:
@@ -365,10 +604,23 @@ elif app_mode == T['mode_deep']:
         # 技术走势图
         st.markdown("---")
         st.subheader(f"📉 {selected_ticker} Chart")
+        chart_range = st.radio("Range", list(ChartEngine.RANGES.keys()), index=4, horizontal=True,
+                               label_visibility="collapsed")
         try:
-            chart_data = yf.Ticker(selected_ticker).history(period="6mo")
-            st.line_chart(chart_data['Close'])
-        except:
+            line_df, marker_df = ChartEngine.build(selected_ticker, chart_range, budget=500, cache=get_history_cache())
+            base_chart = alt.Chart(line_df).mark_line().encode(
+                x=alt.X('Date:T', title=None),
+                y=alt.Y('Close:Q', scale=alt.Scale(zero=False)),
+                tooltip=['Date:T', alt.Tooltip('Close:Q', format='.2f')]
+            )
+            marker_chart = alt.Chart(marker_df).mark_point(color='red', filled=True, size=60).encode(
+                x='Date:T', y='Close:Q',
+                tooltip=['Date:T', alt.Tooltip('Close:Q', format='.2f'), 'Sigma:Q', alt.Tooltip('Return:Q', title='Return %')]
+            )
+            st.altair_chart(base_chart + marker_chart, use_container_width=True)
+            st.caption(f"🔴 {len(marker_df)} radar RED events · {len(line_df)} points")
+        except Exception:
+            metrics.incr("errors", source="chart")
             st.write("Chart Error")
 
         # 删除按钮
@@ -377,15 +629,55 @@ elif app_mode == T['mode_deep']:
             wm.remove(selected_ticker)
             st.rerun()
 
+# --- 场景 D: 组合风险 (Portfolio Risk) ---
+elif app_mode == T['mode_risk']:
+    st.title(T['risk_title'])
+    if len(watchlist) < 2:
+        st.info("关注池至少需要 2 只股票。" if lang_opt == '中文' else "Add at least 2 stocks to the watchlist.")
+    else:
+        tickers = tuple(sorted(watchlist))
+        c_win, c_thr = st.columns(2)
+        alpha = c_win.select_slider("VaR / ES Confidence", options=[0.90, 0.95, 0.99], value=0.95)
+        threshold = c_thr.slider("Cluster correlation threshold" if lang_opt == 'English' else "聚类相关系数阈值", 0.3, 0.95, 0.6, 0.05)
+
+        close, _ = get_cached_panel(tickers)
+        pr = get_portfolio_risk(tickers)
+        pr.update(close)  # 只累加新到的 K 线
+
+        try:
+            port = pr.portfolio(alpha=alpha)
+        except ValueError as e:
+            st.warning(str(e))
+        else:
+            r1, r2, r3, r4 = st.columns(4)
+            r1.metric("Annual Vol (EW)", f"{port['annual_vol']:.1%}")
+            r2.metric(f"VaR {alpha:.0%} (1d)", f"{port['var']:.2%}")
+            r3.metric(f"ES {alpha:.0%} (1d)", f"{port['es']:.2%}")
+            r4.metric("Shrinkage", f"{port['shrinkage']:.2f}", help="Ledoit-Wolf intensity toward scaled identity")
+            st.caption(f"{port['observations']} daily returns · equal-weighted watchlist")
+
+            st.subheader("🔗 " + ("Correlation Matrix" if lang_opt == 'English' else "相关系数矩阵"))
+            st.dataframe(pr.correlation().round(2), use_container_width=True)
+
+            st.subheader("🧩 " + ("Co-moving Clusters" if lang_opt == 'English' else "同涨同跌股票簇"))
+            groups = pr.clusters(threshold=threshold)
+            if groups:
+                for i, g in enumerate(groups, 1):
+                    st.markdown(f"**#{i}** ({len(g)}): {', '.join(g)}")
+            else:
+                st.caption("No clusters above threshold" if lang_opt == 'English' else "没有高于阈值的股票簇")
+
 # --- 场景 C: AI 财报解读 (自动研报版) ---
 # 🔴 关键修复：使用 T['mode_pdf'] 进行判断
 elif app_mode == T['mode_pdf']:
     st.title(T['pdf_title']) # 使用字典标题
     st.caption(T['pdf_caption'])
 
-    # 初始化
-    if 'rag_engine' not in st.session_state:
-        st.session_state['rag_engine'] = RagEngine()
+    # 入库与生成都放到后台任务里跑，job_id 同时记在 URL 上，刷新或断线重连后能重新挂上
+    jm = get_job_manager()
+    for key in ('ingest_job', 'report_job'):
+        if key not in st.session_state and key in st.query_params:
+            st.session_state[key] = st.query_params[key]
 
     # 布局
     col_config, col_report = st.columns([1, 2])
@@ -395,16 +687,22 @@ elif app_mode == T['mode_pdf']:
         api_key = st.text_input(T['api_key'], type="password")
         uploaded_file = st.file_uploader(T['upload_label'], type=["pdf"])
 
-        # 处理文件上传
+        # 处理文件上传：新文件提交一个入库任务
         if uploaded_file:
-            if 'last_file' not in st.session_state or st.session_state['last_file'] != uploaded_file.name:
-                with st.status(T['processing'], expanded=True) as status:
-                    st.write(T['status_ocr'])
-                    msg = st.session_state['rag_engine'].process_pdf(uploaded_file)
-                    st.write(T['status_chunk'])
-                    status.update(label=msg, state="complete", expanded=False)
-                    st.session_state['last_file'] = uploaded_file.name
-                    st.session_state['report_content'] = None
+            file_id = (uploaded_file.name, uploaded_file.size)
+            if st.session_state.get('last_file') != file_id:
+                job_id = jm.submit("ingest", ingest_job, uploaded_file.getvalue(), get_embedding_model(),
+                                   meta={"file": uploaded_file.name})
+                st.session_state['last_file'] = file_id
+                st.session_state['ingest_job'] = st.query_params['ingest_job'] = job_id
+                st.session_state.pop('report_job', None)
+                st.query_params.pop('report_job', None)
+
+        ingest = None
+        if st.session_state.get('ingest_job'):
+            ingest = show_job(st.session_state['ingest_job'], T)
+            if ingest and ingest['status'] == "done":
+                st.success(f"{ingest['meta'].get('file', '')}: {ingest['result']['message']}")
 
         st.markdown("---")
         generate_btn = st.button(T['btn_generate'], type="primary", use_container_width=True)
@@ -415,21 +713,71 @@ elif app_mode == T['mode_pdf']:
         if generate_btn:
             if not api_key:
                 st.error(T['error_key'])
-            elif not uploaded_file:
+            elif ingest is None:
                 st.error(T['error_file'])
+            elif ingest['status'] != "done":
+                st.warning(T['ingest_pending'])
             else:
-                with st.spinner(T['processing']):
-                    # 传入当前语言选项
-                    report = st.session_state['rag_engine'].generate_report(api_key, lang=st.session_state['language'])
-                    st.session_state['report_content'] = report
-
-        if st.session_state.get('report_content'):
-            st.markdown(st.session_state['report_content'])
+                job_id = jm.submit("report", report_job, ingest['result']['persist_dir'], api_key,
+                                   st.session_state['language'], get_embedding_model(),
+                                   meta={"file": ingest['meta'].get('file', ''), "ingest_job": ingest['id']})
+                st.session_state['report_job'] = st.query_params['report_job'] = job_id
+
+        report = show_job(st.session_state['report_job'], T) if st.session_state.get('report_job') else None
+        if report and report['status'] == "done":
+            content = report['result']['report']
+            st.markdown(content)
             st.download_button(
                 label=T['download'],
-                data=st.session_state['report_content'],
-                file_name=f"{uploaded_file.name}_report.md",
+                data=content,
+                file_name=f"{report['meta'].get('file', 'report')}_report.md",
                 mime="text/markdown"
             )
+        elif report is None:
+            st.info("👈 Please upload file and click generate." if lang_opt == 'English' else "👈 请在左侧上传文件并点击生成按钮。")
+
+    # 追问：复用已加载的索引，逐字流式输出，并标注引用的页码 / 章节
+    if ingest and ingest['status'] == "done":
+        st.markdown("---")
+        st.subheader(T['qa_title'])
+        qa = st.session_state.get('qa')
+        if not qa or qa['ingest_job'] != ingest['id']:
+            qa = st.session_state['qa'] = {"ingest_job": ingest['id'], "session": QaSession(), "log": []}
+        for msg in qa['log']:
+            with st.chat_message(msg['role']):
+                st.markdown(msg['content'])
+                show_citations(msg.get('citations'))
+
+        question = st.chat_input(T['qa_placeholder'])
+        if question:
+            if not api_key:
+                st.error(T['error_key'])
+            else:
+                with st.chat_message("user"):
+                    st.markdown(question)
+                engine = get_rag_engine(ingest['result']['persist_dir'])
+                citations, stream = engine.ask(question, api_key, session=qa['session'],
+                                               lang=st.session_state['language'])
+                with st.chat_message("assistant"):
+                    answer = st.write_stream(stream)
+                    show_citations(citations)
+                qa['log'] += [{"role": "user", "content": question},
+                              {"role": "assistant", "content": answer, "citations": citations}]
+
+# ================= 4. 调试面板 (Debug Metrics) =================
+if debug_metrics:
+    with st.expander("🛠️ Render Breakdown / 本轮渲染耗时", expanded=True):
+        breakdown = metrics.render_breakdown()
+        if breakdown:
+            st.dataframe(pd.DataFrame(breakdown), use_container_width=True, hide_index=True)
         else:
-            st.info("👈 Please upload file and click generate." if lang_opt == 'English' else "👈 请在左侧上传文件并点击生成按钮。")
\ No newline at end of file
+            st.caption("No spans recorded in this render.")
+        shared_stats = get_shared_cache().stats()
+        if shared_stats:
+            st.caption("Shared market cache / 跨进程共享缓存")
+            st.dataframe(pd.DataFrame(shared_stats), use_container_width=True, hide_index=True)
+        if not metrics.enabled:
+            st.caption("Process-wide export is off (set QUANT_METRICS=1) / 进程级汇总未开启")
+        d1, d2 = st.columns(2)
+        d1.download_button("📥 Prometheus", data=metrics.to_prometheus(), file_name="metrics.prom", mime="text/plain")
+        d2.download_button("📥 JSON Lines", data=metrics.to_jsonl(), file_name="metrics.jsonl", mime="application/json")
@@ -0,0 +1,191 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from quant_backend import DataEngine, TechnicalFactors, MarketUniverse
+from telemetry import metrics
+
+
+# ================= 评分卡回测引擎 (Scorecard Backtest) =================
+# 把 DeepAnalyzer 评分卡和 RiskRadar 红绿灯的每一条规则都变成 日期 × 股票 的布尔面板，
+# 再与未来 N 日收益对齐，统计命中率 / 平均收益 / 超额收益 / 换手率。
+# 全程是面板级向量运算，没有逐只股票、逐日的 Python 循环。
+
+# 规则 -> 分值 (与 DeepAnalyzer.get_comprehensive_report 保持一致)
+RULE_POINTS = {
+    "roe>20%": 15, "roe>10%": 10,
+    "margin>15%": 15, "margin>5%": 5,
+    "peg<1": 30, "peg<1.5": 20, "pe<20": 20, "pe20-40": 10,
+    "sigma<1.5": 10, "sigma>3": -20,
+    "rsi<30": 20, "rsi30-70": 10, "rsi>80": -10,
+    "radar_green": 10, "radar_red": -10,
+}
+
+
+class ScorecardBacktest:
+    def __init__(self, close, volume, fundamentals=None, horizons=(5, 20, 60)):
+        """
+        close / volume: 日期 × 股票 面板
+        fundamentals: 可选 {'roe', 'profit_margin', 'peg', 'pe'} -> 面板 (需为当时可得的数据，
+                      如按披露日前向填充的季度值)；缺省时只回测技术面规则
+        """
+        self.close = close
+        self.volume = volume.reindex_like(close)
+        self.fundamentals = {k: v.reindex_like(close) for k, v in (fundamentals or {}).items()}
+        self.horizons = horizons
+        self._rules = None
+
+    # ---------- 1. 因子面板 ----------
+    def factors(self):
+        with metrics.span("backtest.factors"):
+            return {
+                "rsi": TechnicalFactors.rsi(self.close),
+                "sigma": TechnicalFactors.sigma(self.close),
+                "level": TechnicalFactors.radar_level(self.close, self.volume),
+            }
+
+    def rules(self):
+        """每条规则一个布尔面板 (互斥档位与评分卡的 if/elif 顺序一致)"""
+        if self._rules is not None:
+            return self._rules
+        f = self.factors()
+        rsi, sig, level = f["rsi"], f["sigma"], f["level"]
+        r = {
+            "sigma<1.5": sig < 1.5,
+            "sigma>3": sig > 3.0,
+            "rsi<30": rsi < 30,
+            "rsi30-70": (rsi >= 30) & (rsi <= 70),
+            "rsi>80": rsi > 80,
+            "radar_green": level == TechnicalFactors.LEVEL_GREEN,
+            "radar_red": level == TechnicalFactors.LEVEL_RED,
+        }
+        fd = self.fundamentals
+        if "roe" in fd:
+            r["roe>20%"] = fd["roe"] > 0.20
+            r["roe>10%"] = (fd["roe"] > 0.10) & ~r["roe>20%"]
+        if "profit_margin" in fd:
+            r["margin>15%"] = fd["profit_margin"] > 0.15
+            r["margin>5%"] = (fd["profit_margin"] > 0.05) & ~r["margin>15%"]
+        if "peg" in fd:
+            peg = fd["peg"]
+            r["peg<1"] = (peg > 0) & (peg < 1.0)
+            r["peg<1.5"] = (peg < 1.5) & ~r["peg<1"]
+            has_peg = r["peg<1"] | r["peg<1.5"]
+        else:
+            has_peg = False
+        if "pe" in fd:
+            pe = fd["pe"]
+            r["pe<20"] = (pe > 0) & (pe < 20) & ~has_peg
+            r["pe20-40"] = (pe >= 20) & (pe < 40) & ~has_peg
+        self._rules = r
+        return r
+
+    def scores(self):
+        """时点评分面板 (0-100)；没有基本面时只含技术面分值"""
+        rules = self.rules()
+        total = sum(mask.astype("float64") * RULE_POINTS[name] for name, mask in rules.items())
+        return total.clip(0, 100).where(self.close.notna())
+
+    # ---------- 2. 收益与统计 ----------
+    def forward_returns(self, h):
+        return self.close.shift(-h) / self.close - 1
+
+    @staticmethod
+    def _turnover(mask):
+        """每天新进入信号的占比：新增信号数 / 持有信号数"""
+        prev = mask.shift(1, fill_value=False)
+        entries = (mask & ~prev).to_numpy().sum()
+        held = mask.to_numpy().sum()
+        return entries / held if held else np.nan
+
+    def rule_stats(self, dates=None):
+        """
+        每条规则 × 每个持有期：信号数、命中率 (未来收益>0)、平均收益、
+        相对同日全市场平均的超额收益、换手率
+        """
+        rules = self.rules()
+        rows = []
+        with metrics.span("backtest.rule_stats"):
+            for h in self.horizons:
+                fwd = self.forward_returns(h)
+                excess = fwd.sub(fwd.mean(axis=1), axis=0)
+                if dates is not None:
+                    fwd, excess = fwd.loc[dates], excess.loc[dates]
+                fwd_v, exc_v = fwd.to_numpy(), excess.to_numpy()
+                valid = ~np.isnan(fwd_v)
+                for name, mask in rules.items():
+                    m = mask.loc[dates] if dates is not None else mask
+                    sel = m.to_numpy(dtype=bool) & valid
+                    n = int(sel.sum())
+                    rows.append({
+                        "rule": name, "points": RULE_POINTS[name], "horizon": h, "signals": n,
+                        "hit_rate": float((fwd_v[sel] > 0).mean()) if n else np.nan,
+                        "mean_fwd": float(fwd_v[sel].mean()) if n else np.nan,
+                        "excess": float(exc_v[sel].mean()) if n else np.nan,
+                        "turnover": self._turnover(m),
+                    })
+        return pd.DataFrame(rows)
+
+    def score_quantiles(self, h=20, buckets=5):
+        """按当日评分横截面分组，统计每组未来收益 + 每日秩相关 IC"""
+        score, fwd = self.scores(), self.forward_returns(h)
+        rank_s = score.rank(axis=1, pct=True)
+        rank_f = fwd.rank(axis=1, pct=True)
+        bucket = np.ceil(rank_s * buckets).clip(1, buckets)
+
+        b, f = bucket.to_numpy().ravel(), fwd.to_numpy().ravel()
+        ok = ~np.isnan(b) & ~np.isnan(f)
+        table = (pd.DataFrame({"bucket": b[ok].astype(int), "fwd": f[ok]})
+                 .groupby("bucket")["fwd"].agg(["count", "mean", lambda x: (x > 0).mean()]))
+        table.columns = ["count", "mean_fwd", "hit_rate"]
+
+        # 每日 Spearman IC：对两组秩做逐行 Pearson
+        a, c = rank_s.to_numpy(), rank_f.to_numpy()
+        both = ~np.isnan(a) & ~np.isnan(c)
+        a, c = np.where(both, a, np.nan), np.where(both, c, np.nan)
+        n = both.sum(axis=1, keepdims=True)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            a = a - np.nansum(a, axis=1, keepdims=True) / n
+            c = c - np.nansum(c, axis=1, keepdims=True) / n
+            ic = np.nansum(a * c, axis=1) / np.sqrt(np.nansum(a * a, axis=1) * np.nansum(c * c, axis=1))
+        ic = pd.Series(ic, index=score.index).dropna()
+        return table, ic
+
+    def walk_forward(self, folds=5):
+        """把样本期切成连续的若干段，逐段统计规则表现，看信号是否跨时期稳定"""
+        dates = self.close.index
+        edges = np.linspace(0, len(dates), folds + 1).astype(int)
+        out = []
+        for i in range(folds):
+            window = dates[edges[i]:edges[i + 1]]
+            stats = self.rule_stats(dates=window)
+            stats.insert(0, "fold", f"{window[0]:%Y-%m}~{window[-1]:%Y-%m}")
+            out.append(stats)
+        return pd.concat(out, ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtest DeepAnalyzer scorecard / RiskRadar rules")
+    parser.add_argument("tickers", nargs="*", help="默认使用美股核心池")
+    parser.add_argument("--period", default="10y")
+    parser.add_argument("--horizon", type=int, default=20)
+    parser.add_argument("--folds", type=int, default=5)
+    args = parser.parse_args()
+
+    tickers = args.tickers or MarketUniverse.get_tickers_by_market("🇺🇸 美股市场 (S&P 100核心)")
+    close, volume = DataEngine.get_price_panel(tickers, period=args.period)
+
+    t0 = time.perf_counter()
+    bt = ScorecardBacktest(close, volume, horizons=(args.horizon,))
+    stats = bt.rule_stats()
+    table, ic = bt.score_quantiles(h=args.horizon)
+    wf = bt.walk_forward(folds=args.folds)
+    elapsed = time.perf_counter() - t0
+
+    pd.set_option("display.width", 160)
+    print(f"Panel: {close.shape[0]} dates x {close.shape[1]} tickers, computed in {elapsed:.2f}s\n")
+    print(stats.round(4).to_string(index=False))
+    print(f"\nScore quintiles (fwd {args.horizon}d), mean IC = {ic.mean():.4f}, IC IR = {ic.mean() / ic.std():.2f}")
+    print(table.round(4).to_string())
+    print("\nWalk-forward hit rate by fold:")
+    print(wf.pivot(index="rule", columns="fold", values="hit_rate").round(3).to_string())
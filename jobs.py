@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from telemetry import metrics
+
+
+# ================= 后台任务层 (Background Jobs) =================
+# PDF 入库、研报生成这类耗时操作不再阻塞 Streamlit 脚本线程：
+#   - 提交后立即返回 job_id，页面轮询进度；
+#   - 状态 / 进度 / 结果落盘到 data/jobs/{id}.json，刷新页面、断线重连后可以重新挂上；
+#   - 任务函数通过 ctx.progress() 汇报进度，并在检查点响应取消；
+#   - 每条记录带 owner (host/pid/boot)，重启时只回收本机已经不在的进程留下的任务；
+#   - 结束超过 ttl 的任务连同 ctx.add_artifact() 登记的目录一起清理。
+
+# 每个进程启动时生成一次：PID 会被复用 (容器里应用总是 PID 1)，只有 boot 相同才是同一个进程
+BOOT = uuid.uuid4().hex
+
+
+class JobCancelled(Exception):
+    """任务在检查点发现已被取消"""
+
+
+class JobContext:
+    def __init__(self, manager, job_id):
+        self._manager = manager
+        self.job_id = job_id
+        self._cancel = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def check(self):
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def progress(self, fraction, message=""):
+        """汇报进度 (0~1)，同时作为取消检查点"""
+        self.check()
+        self._manager._update(self.job_id, progress=round(float(fraction), 3), message=message)
+
+    def add_artifact(self, path):
+        """登记任务产生的文件 / 目录，记录过期清理时一并删除"""
+        with self._manager._lock:
+            artifacts = self._manager._jobs[self.job_id]["artifacts"] + [path]
+        self._manager._update(self.job_id, artifacts=artifacts)
+
+
+class JobManager:
+    FINAL_STATES = ("done", "failed", "cancelled")
+
+    def __init__(self, directory="data/jobs", max_workers=2, ttl_hours=72, on_expire=None):
+        self.directory = directory
+        self.ttl = ttl_hours * 3600
+        self.on_expire = on_expire  # 可选回调 on_expire(job)：记录和产物删除后调用，用于释放引用它们的缓存
+        self.owner = {"host": socket.gethostname(), "pid": os.getpid(), "boot": BOOT}
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = {}
+        self._contexts = {}
+        self._lock = threading.Lock()
+        self._last_cleanup = 0.0
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+        self.cleanup()
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _persist(self, job):
+        tmp = self._path(job["id"]) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp, self._path(job["id"]))
+
+    @staticmethod
+    def _pid_alive(pid):
+        if os.name == "nt":
+            return True  # Windows 上 os.kill(pid, 0) 会结束进程，无法这样探测；保守地当作还活着
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            return True
+        return True
+
+    def _orphaned(self, job):
+        """本机上执行该任务的进程已经不在了 (其他主机 / 仍在运行的进程的任务不动)"""
+        owner = job.get("owner")
+        if owner is None:
+            return True  # 没有 owner 的旧记录
+        if owner.get("host") != self.owner["host"]:
+            return False
+        if owner.get("boot") == BOOT:
+            return False  # 本进程 (可能是另一个 JobManager 实例) 正在跑
+        if owner.get("pid") == os.getpid():
+            return True  # PID 相同但 boot 不同：上一个进程留下的，PID 被复用了
+        return not self._pid_alive(owner.get("pid"))
+
+    def _recover(self):
+        """进程重启后：本机上次没跑完、且执行进程已退出的任务标记为中断"""
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            job = self._load(name[:-5])
+            if job and job["status"] not in self.FINAL_STATES and self._orphaned(job):
+                job.update(status="failed", error="interrupted (process restarted)", finished=time.time())
+                self._persist(job)
+
+    def cleanup(self, ttl=None):
+        """删除结束超过 ttl 秒的任务：磁盘记录、内存条目、登记的产物目录；返回删除条数"""
+        ttl = self.ttl if ttl is None else ttl
+        cutoff = time.time() - ttl
+        self._last_cleanup = time.time()
+        removed = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            job = self._load(name[:-5])
+            if not job or job["status"] not in self.FINAL_STATES or (job.get("finished") or 0) > cutoff:
+                continue
+            for path in job.get("artifacts", []):
+                shutil.rmtree(path, ignore_errors=True)
+            try:
+                os.remove(self._path(job["id"]))
+            except OSError:
+                pass
+            with self._lock:
+                self._jobs.pop(job["id"], None)
+            if self.on_expire is not None:
+                try:
+                    self.on_expire(job)
+                except Exception as e:
+                    print(f"Job expire hook failed: {e}")
+            removed += 1
+        if removed:
+            metrics.incr("jobs_expired", value=removed)
+        return removed
+
+    def _load(self, job_id):
+        try:
+            with open(self._path(job_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(fields)
+            snapshot = dict(job)
+        self._persist(snapshot)
+
+    def submit(self, kind, fn, *args, meta=None, **kwargs):
+        """提交任务：fn(ctx, *args, **kwargs) 的返回值 (需可 JSON 序列化) 作为结果保存"""
+        job_id = uuid.uuid4().hex[:12]
+        job = {"id": job_id, "kind": kind, "status": "queued", "progress": 0.0, "message": "",
+               "meta": meta or {}, "result": None, "error": None, "owner": self.owner, "artifacts": [],
+               "created": time.time(), "started": None, "finished": None}
+        ctx = JobContext(self, job_id)
+        with self._lock:
+            self._jobs[job_id] = job
+            self._contexts[job_id] = ctx
+        self._persist(job)
+        self._pool.submit(metrics.bind(self._run), job_id, ctx, fn, args, kwargs)
+        metrics.incr("jobs_submitted", kind=kind)
+        if time.time() - self._last_cleanup > 3600:  # 长时间运行的进程也定期清一次
+            self._pool.submit(self.cleanup)
+        return job_id
+
+    def _run(self, job_id, ctx, fn, args, kwargs):
+        if ctx.cancelled:
+            self._update(job_id, status="cancelled", finished=time.time())
+            return
+        self._update(job_id, status="running", started=time.time())
+        kind = self._jobs[job_id]["kind"]
+        try:
+            with metrics.span("job.run", kind=kind):
+                result = fn(ctx, *args, **kwargs)
+            self._update(job_id, status="done", progress=1.0, result=result, finished=time.time())
+        except JobCancelled:
+            self._update(job_id, status="cancelled", finished=time.time())
+        except Exception as e:
+            metrics.incr("errors", source=f"job_{kind}")
+            self._update(job_id, status="failed", error=str(e), finished=time.time())
+        finally:
+            with self._lock:
+                self._contexts.pop(job_id, None)
+
+    def get(self, job_id):
+        """内存里没有 (例如其他进程提交的、或重启前的任务) 就从磁盘读"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+        return self._load(job_id)
+
+    def cancel(self, job_id):
+        with self._lock:
+            ctx = self._contexts.get(job_id)
+        if ctx is None:
+            return False
+        ctx._cancel.set()
+        return True
+
+    def list(self, kind=None, limit=20):
+        jobs = [self._load(n[:-5]) for n in os.listdir(self.directory) if n.endswith(".json")]
+        jobs = [j for j in jobs if j and (kind is None or j["kind"] == kind)]
+        return sorted(jobs, key=lambda j: j["created"], reverse=True)[:limit]
@@ -0,0 +1,413 @@
+import os
+import sys
+import json
+import time
+import zlib
+import shutil
+import argparse
+import tempfile
+import threading
+import traceback
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import yfinance as yf
+
+
+# ================= 并发会话压测 (Concurrent-session Load Test) =================
+# 用 Streamlit 的 AppTest 同时驱动 N 个模拟会话走 海选 / 深度监控 / 财报解读 三条流程，
+# 行情走回放数据源 (不访问 Yahoo)，LLM 用桩 (不访问 DeepSeek)，
+# 输出每条流程的延迟分位数、内存增长和错误率随 N 的变化。
+#
+# 用法：python load_test.py --sessions 1,2,4,8 [--pdf report.pdf] [--replay-dir replay_data] [--latency 0.05]
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+# ---------- 1. 回放数据源 (Replay Provider) ----------
+class ReplayProvider:
+    """
+    replay_dir 下有 {ticker}.pkl (日线) / {ticker}.json ({"info", "news"}) 时按录制数据回放，
+    否则按代码生成确定性的合成数据。latency 模拟上游网络延迟。
+    """
+    PERIOD_BARS = {"1d": 1, "5d": 5, "1mo": 21, "2mo": 42, "3mo": 63, "6mo": 126, "1y": 252, "2y": 504,
+                   "5y": 1260, "10y": 2520, "max": 2520}
+    CURRENCIES = {"HK": "HKD", "AX": "AUD", "SS": "CNY", "SZ": "CNY"}
+
+    def __init__(self, replay_dir=None, latency=0.0):
+        self.replay_dir = replay_dir
+        self.latency = latency
+        self._daily = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _sleep(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    @staticmethod
+    def _seed(ticker):
+        return zlib.crc32(ticker.encode())
+
+    def daily(self, ticker):
+        with self._lock:
+            if ticker in self._daily:
+                return self._daily[ticker]
+        path = os.path.join(self.replay_dir or "", f"{ticker}.pkl")
+        if self.replay_dir and os.path.exists(path):
+            df = pd.read_pickle(path)
+        else:
+            rng = np.random.default_rng(self._seed(ticker))
+            idx = pd.bdate_range(end=pd.Timestamp.today().normalize(), periods=2520, tz="America/New_York")
+            close = 50 * np.exp(np.cumsum(rng.normal(0.0003, 0.018, len(idx))))
+            df = pd.DataFrame({"Open": close, "High": close * 1.01, "Low": close * 0.99, "Close": close,
+                               "Volume": rng.integers(1_000_000, 5_000_000, len(idx)).astype(float)}, index=idx)
+        with self._lock:
+            self._daily[ticker] = df
+        return df
+
+    def info(self, ticker):
+        path = os.path.join(self.replay_dir or "", f"{ticker}.json")
+        if self.replay_dir and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)["info"]
+        rng = np.random.default_rng(self._seed(ticker) + 1)
+        return {"shortName": f"{ticker} Corp", "currentPrice": float(self.daily(ticker)["Close"].iloc[-1]),
+                "trailingPE": float(rng.uniform(5, 60)), "returnOnEquity": float(rng.uniform(-0.05, 0.4)),
+                "marketCap": float(rng.uniform(1e10, 2e12)), "debtToEquity": float(rng.uniform(0, 200)),
+                "pegRatio": float(rng.uniform(0.5, 3)), "profitMargins": float(rng.uniform(0, 0.35)),
+                "grossMargins": float(rng.uniform(0.2, 0.7)), "operatingMargins": float(rng.uniform(0, 0.4)),
+                "currency": self.CURRENCIES.get(ticker.rpartition(".")[2], "USD")}
+
+    def news(self, ticker):
+        path = os.path.join(self.replay_dir or "", f"{ticker}.json")
+        if self.replay_dir and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f).get("news", [])
+        titles = ["beats earnings expectations", "faces regulatory probe", "announces new product line",
+                  "shares slip after guidance cut", "expands buyback program"]
+        return [{"content": {"title": f"{ticker} {t}", "canonicalUrl": {"url": "https://example.com"},
+                             "pubDate": "2026-01-01"}} for t in titles]
+
+    def history(self, ticker, period=None, start=None, interval="1d", **kwargs):
+        self._sleep()
+        df = self.daily(ticker)
+        if interval != "1d":  # 日内：直接用最近几根日线插值出等间隔的 K 线
+            bars = {"1d": 78, "5d": 65}.get(period, 78)
+            end = pd.Timestamp.now(tz="America/New_York").floor("5min")
+            idx = pd.date_range(end=end, periods=bars, freq="5min" if period == "1d" else "30min")
+            close = np.interp(np.linspace(0, 1, bars), [0, 1], df["Close"].iloc[-2:].to_numpy())
+            return pd.DataFrame({"Close": close, "Volume": 1e5}, index=idx)
+        if start is not None:
+            return df[df.index >= pd.Timestamp(start, tz=df.index.tz)].copy()
+        return df.tail(self.PERIOD_BARS.get(period, 126)).copy()
+
+    def download(self, tickers, period="1y", **kwargs):
+        self._sleep()
+        tickers = [tickers] if isinstance(tickers, str) else list(tickers)
+        bars = self.PERIOD_BARS.get(period, 252)
+        frames = {t: self._fx(t, bars) if t.endswith("=X") else self.daily(t).tail(bars) for t in tickers}
+        close = pd.DataFrame({t: f["Close"] for t, f in frames.items()})
+        volume = pd.DataFrame({t: f["Volume"] for t, f in frames.items()})
+        return pd.concat({"Close": close, "Volume": volume}, axis=1)
+
+    def _fx(self, pair, bars):
+        """USDxxx=X 货币对：在内置近似汇率附近的平稳序列"""
+        from quant_backend import FxTable
+        idx = self.daily("SPY").tail(bars).index
+        rate = FxTable.DEFAULT_RATES.get(pair[3:6], 1.0)
+        return pd.DataFrame({"Close": rate, "Volume": 0.0}, index=idx)
+
+    def record(self, tickers, period="10y"):
+        """把真实数据录下来，之后可以离线回放"""
+        os.makedirs(self.replay_dir, exist_ok=True)
+        for t in tickers:
+            stock = _REAL_TICKER(t)
+            stock.history(period=period).to_pickle(os.path.join(self.replay_dir, f"{t}.pkl"))
+            with open(os.path.join(self.replay_dir, f"{t}.json"), "w", encoding="utf-8") as f:
+                json.dump({"info": stock.info, "news": stock.news}, f, ensure_ascii=False, default=str)
+            print(f"recorded {t}")
+
+
+_REAL_TICKER = yf.Ticker
+
+
+class ReplayTicker:
+    provider = None  # install() 时注入
+
+    def __init__(self, ticker, *args, **kwargs):
+        self.ticker = ticker
+
+    @property
+    def info(self):
+        self.provider._sleep()
+        return self.provider.info(self.ticker)
+
+    @property
+    def news(self):
+        self.provider._sleep()
+        return self.provider.news(self.ticker)
+
+    def history(self, *args, **kwargs):
+        return self.provider.history(self.ticker, *args, **kwargs)
+
+
+# ---------- 2. LLM 桩 (Stub LLM) ----------
+class _StubCompletions:
+    def __init__(self, delay):
+        self.delay = delay
+
+    def create(self, model=None, messages=None, stream=False, **kwargs):
+        time.sleep(self.delay)
+        text = "## 1. Financial Highlights\n(stub report)\n## 2. Operational Analysis\n(stub)"
+        if stream:
+            return iter([_obj(choices=[_obj(delta=_obj(content=w + " "))]) for w in text.split(" ")])
+        return _obj(choices=[_obj(message=_obj(content=text))])
+
+
+class _obj:
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+
+class StubOpenAI:
+    delay = 0.5
+
+    def __init__(self, *args, **kwargs):
+        self.chat = _obj(completions=_StubCompletions(StubOpenAI.delay))
+
+
+def install(provider, llm_delay=0.5, stub_embeddings=False):
+    """把 yfinance / OpenAI (/ 向量模型) 换成回放与桩实现"""
+    ReplayTicker.provider = provider
+    yf.Ticker = ReplayTicker
+    yf.download = provider.download
+    StubOpenAI.delay = llm_delay
+    import rag_engine
+    rag_engine.OpenAI = StubOpenAI
+    if stub_embeddings:
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        rag_engine.RagEngine.load_embedding_model = staticmethod(lambda: DeterministicFakeEmbedding(size=512))
+
+
+# ---------- 3. 会话流程 ----------
+def _rss_mb():
+    """当前常驻内存 (Linux 读 /proc，其他平台退回峰值)"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource  # 仅 Unix
+    except ImportError:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _app_errors(at):
+    return [e.message for e in at.exception]
+
+
+def _select_mode(at, label_prefix):
+    mode_radio = at.sidebar.radio[1]  # [0] 是语言切换
+    option = next(o for o in mode_radio.options if o.startswith(label_prefix))
+    mode_radio.set_value(option).run()
+
+
+def flow_screener(at, ctx):
+    _select_mode(at, "🔍")
+    next(b for b in at.button if b.label.startswith("🚀")).click().run()
+    return _app_errors(at)
+
+
+def flow_screener_all(at, ctx):
+    """四个市场合并扫描 (80+ 只)"""
+    _select_mode(at, "🔍")
+    markets = next(m for m in at.multiselect if m.label in ("Markets", "市场"))
+    markets.set_value(list(markets.options)).run()
+    next(b for b in at.button if b.label.startswith("🚀")).click().run()
+    return _app_errors(at)
+
+
+def flow_deep(at, ctx):
+    _select_mode(at, "📊")
+    return _app_errors(at)
+
+
+def flow_pdf(at, ctx):
+    """AppTest 不支持 file_uploader，这条流程直接提交与页面相同的后台任务并轮询到结束"""
+    from rag_engine import ingest_job, report_job
+    jm, model = _job_env()
+    with open(ctx["pdf"], "rb") as f:
+        ingest = _wait_job(jm, jm.submit("ingest", ingest_job, f.read(), model))
+    if ingest["status"] != "done":
+        return [ingest["error"] or ingest["status"]]
+    report = _wait_job(jm, jm.submit("report", report_job, ingest["result"]["persist_dir"], "stub-key",
+                                     embedding_model=model))
+    if report["status"] != "done":
+        return [report["error"] or report["status"]]
+    text = report["result"]["report"]
+    return [text] if text.startswith(("❌", "⚠️")) else []
+
+
+def flow_qa(at, ctx):
+    """入库后连续追问三轮 (与页面一样复用同一个已加载的索引)"""
+    from rag_engine import RagEngine, QaSession, ingest_job
+    jm, model = _job_env()
+    with open(ctx["pdf"], "rb") as f:
+        ingest = _wait_job(jm, jm.submit("ingest", ingest_job, f.read(), model))
+    if ingest["status"] != "done":
+        return [ingest["error"] or ingest["status"]]
+    engine, session, errors = RagEngine(ingest["result"]["persist_dir"], embedding_model=model), QaSession(), []
+    for question in ("What drove revenue growth?", "What are the main risks?", "What is the outlook?"):
+        citations, stream = engine.ask(question, "stub-key", session=session)
+        answer = "".join(stream)
+        if not citations or "❌" in answer:
+            errors.append(answer or "no citations")
+    return errors
+
+
+_JOB_ENV = []
+_JOB_ENV_LOCK = threading.Lock()
+
+
+def _job_env():
+    """与页面一致：进程内一个 JobManager、一份 Embedding 模型"""
+    with _JOB_ENV_LOCK:
+        if not _JOB_ENV:
+            from jobs import JobManager
+            from rag_engine import RagEngine
+            _JOB_ENV.extend([JobManager(), RagEngine.load_embedding_model()])
+        return _JOB_ENV
+
+
+def _wait_job(jm, job_id, poll=0.2):
+    while True:
+        job = jm.get(job_id)
+        if job["status"] in jm.FINAL_STATES:
+            return job
+        time.sleep(poll)
+
+
+FLOWS = {"screener": flow_screener, "screener_all": flow_screener_all, "deep": flow_deep, "pdf": flow_pdf, "qa": flow_qa}
+
+
+def run_session(session_id, flows, args):
+    from streamlit.testing.v1 import AppTest
+    results = []
+    at = AppTest.from_file(APP_PATH, default_timeout=args.timeout)
+    ctx = {"pdf": args.pdf}
+    try:
+        t = time.perf_counter()
+        at.run()
+        results.append(("initial", time.perf_counter() - t, _app_errors(at)))
+    except Exception as e:
+        return [("initial", 0.0, [repr(e)])]
+    for name in flows:
+        t = time.perf_counter()
+        try:
+            errors = FLOWS[name](at, ctx)
+        except Exception:
+            errors = [traceback.format_exc(limit=2)]
+        results.append((name, time.perf_counter() - t, errors))
+    return results
+
+
+@contextlib.contextmanager
+def _serial_ast_parse():
+    """
+    CPython 3.11 的 ast.parse 并发调用不是线程安全的 (gh-106905)，多个 AppTest 会话同时编译脚本时会偶发
+    "AST constructor recursion depth mismatch"。只在并发会话运行期间把它串行化，结束后恢复原函数
+    """
+    import ast
+    parse, lock = ast.parse, threading.Lock()
+
+    def locked_parse(*args, **kwargs):
+        with lock:
+            return parse(*args, **kwargs)
+    ast.parse = locked_parse
+    try:
+        yield
+    finally:
+        ast.parse = parse
+
+
+def run_level(n, flows, args):
+    rss_before = _rss_mb()
+    t0 = time.perf_counter()
+    with _serial_ast_parse(), ThreadPoolExecutor(max_workers=n) as pool:
+        sessions = list(pool.map(lambda i: run_session(i, flows, args), range(n)))
+    wall = time.perf_counter() - t0
+
+    rows = []
+    by_flow = {}
+    for records in sessions:
+        for name, seconds, errors in records:
+            by_flow.setdefault(name, []).append((seconds, errors))
+    for name, samples in by_flow.items():
+        lat = np.array([s for s, _ in samples])
+        errs = [e for _, e in samples if e]
+        rows.append({"sessions": n, "flow": name, "runs": len(samples),
+                     "p50_s": round(float(np.percentile(lat, 50)), 3),
+                     "p95_s": round(float(np.percentile(lat, 95)), 3),
+                     "p99_s": round(float(np.percentile(lat, 99)), 3),
+                     "error_rate": round(len(errs) / len(samples), 3),
+                     "sample_error": (errs[0][0][:120] if errs else "")})
+    summary = {"sessions": n, "wall_s": round(wall, 2), "rss_mb": round(_rss_mb(), 1),
+               "rss_growth_mb": round(_rss_mb() - rss_before, 1)}
+    return rows, summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for app.py")
+    parser.add_argument("--sessions", default="1,2,4,8", help="逗号分隔的并发会话数序列")
+    parser.add_argument("--flows", default="screener,deep,pdf")
+    parser.add_argument("--pdf", help="PDF 流程使用的样例财报；不提供则跳过 PDF 流程")
+    parser.add_argument("--replay-dir", help="录制数据目录；不提供则用合成数据")
+    parser.add_argument("--record", nargs="*", help="先录制这些代码的真实数据到 --replay-dir")
+    parser.add_argument("--latency", type=float, default=0.05, help="模拟的上游延迟 (秒/次)")
+    parser.add_argument("--llm-delay", type=float, default=0.5)
+    parser.add_argument("--stub-embeddings", action="store_true", help="用确定性假向量代替 HuggingFace 模型")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", help="结果另存为 JSON")
+    args = parser.parse_args()
+
+    provider = ReplayProvider(args.replay_dir, latency=args.latency)
+    if args.record:
+        provider.record(args.record)
+    install(provider, llm_delay=args.llm_delay, stub_embeddings=args.stub_embeddings)
+
+    flows = [f for f in args.flows.split(",") if f in FLOWS and (f not in ("pdf", "qa") or args.pdf)]
+    if args.pdf:
+        args.pdf = os.path.abspath(args.pdf)
+
+    # 在临时目录里跑，避免污染真实的 watchlist.json / 向量库 / 缓存
+    workdir = tempfile.mkdtemp(prefix="quant_load_")
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+
+    all_rows, summaries = [], []
+    try:
+        for n in [int(x) for x in args.sessions.split(",")]:
+            rows, summary = run_level(n, flows, args)
+            all_rows += rows
+            summaries.append(summary)
+            print(f"N={n}: wall {summary['wall_s']}s, RSS {summary['rss_mb']} MB (+{summary['rss_growth_mb']})")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    pd.set_option("display.width", 200)
+    print()
+    print(pd.DataFrame(all_rows).to_string(index=False))
+    print()
+    print(pd.DataFrame(summaries).to_string(index=False))
+    print(f"\nupstream calls (replayed): {provider.calls}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"flows": all_rows, "levels": summaries}, f, indent=2)
@@ -2,9 +2,23 @@ from textblob import TextBlob
 import yfinance as yf
 import pandas as pd
 import numpy as np
+import ast
+import bisect
+import csv
+import glob
 import json
 import os
+import re
+import shutil
+import threading
+import time
+import hashlib
+import urllib.request
 from datetime import datetime
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from telemetry import metrics
+from upstream import UPSTREAM, CircuitOpenError, is_rate_limited
 
 
 # ================= 1. 数据持久化层 (Persistence Layer) =================
@@ -59,7 +73,8 @@ class DataEngine:
         """获取静态基本面数据（用于筛选和对比）"""
         try:
             stock = yf.Ticker(ticker)
-            info = stock.info
+            with metrics.span("upstream.info", caller="fundamentals"):
+                info = UPSTREAM.call("yahoo", lambda: stock.info)
             return {
                 "symbol": ticker,
                 "name": info.get('shortName', ticker),
@@ -67,44 +82,159 @@ class DataEngine:
                 "pe": info.get('trailingPE', None),
                 "roe": info.get('returnOnEquity', 0),  # 小数
                 "market_cap": info.get('marketCap', 0),
-                "debt_to_equity": info.get('debtToEquity', None)
+                "debt_to_equity": info.get('debtToEquity', None),
+                "peg": info.get('pegRatio', info.get('trailingPegRatio')),
+                "profit_margin": info.get('profitMargins', None),
+                "gross_margin": info.get('grossMargins', None),
+                "operating_margin": info.get('operatingMargins', None),
+                "currency": info.get('currency', 'USD')
             }
         except Exception as e:
+            metrics.incr("errors", source="fundamentals")
             print(f"Error fetching {ticker}: {e}")
             return None
 
+    # 所有海选 / 快照刷新共用一条抓取流水线：同一只股票同时只会有一个在途请求 (多个会话同时扫描时合并)
+    _pool = ThreadPoolExecutor(max_workers=UPSTREAM.max_concurrency, thread_name_prefix="fetch")
+    _inflight = {}
+    _inflight_lock = threading.Lock()
+    _revalidating = set()  # 正在后台刷新的过期行，受 _inflight_lock 保护
+
+    @staticmethod
+    def _fetch_shared(ticker):
+        with DataEngine._inflight_lock:
+            future = DataEngine._inflight.get(ticker)
+            created = future is None
+            if created:
+                future = DataEngine._pool.submit(metrics.bind(DataEngine.get_fundamentals), ticker)
+                DataEngine._inflight[ticker] = future
+        if created:
+            future.add_done_callback(lambda f: DataEngine._inflight.pop(ticker, None)
+                                     if DataEngine._inflight.get(ticker) is f else None)
+        else:
+            metrics.incr("fetch_coalesced")
+        return future
+
+    @staticmethod
+    def _revalidate(tickers, cache):
+        """后台刷新过期行：提交到共享抓取池，全部完成后一次写回 cache。
+        已经在刷新中的股票跳过，扫描再频繁也不会堆积刷新任务"""
+        with DataEngine._inflight_lock:
+            tickers = [t for t in dict.fromkeys(tickers) if t not in DataEngine._revalidating]
+            DataEngine._revalidating.update(tickers)
+        if not tickers:
+            return
+        results, lock = {}, threading.Lock()
+
+        def done(ticker, future):
+            with lock:
+                results[ticker] = future.result()
+                if len(results) < len(tickers):
+                    return
+            try:
+                cache.upsert([d for d in results.values() if d])
+            except Exception as e:
+                metrics.incr("errors", source="revalidate")
+                print(f"Revalidate failed: {e}")
+            finally:
+                with DataEngine._inflight_lock:
+                    DataEngine._revalidating.difference_update(tickers)
+
+        for t in tickers:
+            DataEngine._fetch_shared(t).add_done_callback(lambda f, t=t: done(t, f))
+
+    @staticmethod
+    def get_fundamentals_many(tickers, cache=None, max_age=None, stale_ok=False):
+        """批量取基本面：cache (FundamentalsSnapshot) 里足够新的直接用，其余并发抓取并写回 cache。
+        stale_ok=True 时过期的缓存行也先返回，同时在后台刷新 (stale-while-revalidate)。
+        返回 {ticker: dict 或 None}"""
+        fresh, stale = {}, []
+        if cache is not None:
+            snap = cache.load()
+            if len(snap) and 'symbol' in snap:
+                cutoff = time.time() - (cache.max_age if max_age is None else max_age)
+                hit = snap[snap['symbol'].isin(tickers) & (snap['asof'] >= (0 if stale_ok else cutoff))]
+                for row in hit.to_dict('records'):
+                    fresh[row['symbol']] = {k: (None if isinstance(v, float) and np.isnan(v) else v)
+                                            for k, v in row.items()}
+                    if row['asof'] < cutoff:
+                        stale.append(row['symbol'])
+            metrics.incr("cache_hit", value=len(fresh) - len(stale), cache="fundamentals")
+            if stale:
+                metrics.incr("cache_stale", value=len(stale), cache="fundamentals")
+                DataEngine._revalidate(stale, cache)
+
+        # 实际并发度由 UPSTREAM 的自适应限流器控制，遇到 429 会自动收缩
+        futures = {t: DataEngine._fetch_shared(t) for t in dict.fromkeys(tickers) if t not in fresh}
+        fetched = {t: f.result() for t, f in futures.items()}
+        if cache is not None and any(fetched.values()):
+            cache.upsert([d for d in fetched.values() if d])
+        return {t: fresh.get(t) or fetched.get(t) for t in tickers}
+
     @staticmethod
-    def run_screener(stock_pool, min_roe=0.15, max_pe=50):
-        """执行海选逻辑"""
+    def run_screener(stock_pool, min_roe=0.15, max_pe=50, currency=None, fx=None, cache=None, max_age=None,
+                     stale_ok=False):
+        """执行海选逻辑；stock_pool 可以混合多个市场。
+        currency: 给定时把股价、市值按 fx (FxTable) 换算成该币种；cache: 可选 FundamentalsSnapshot 作为共享缓存"""
+        with metrics.span("screener.fetch", tickers=len(stock_pool)):
+            fetched = DataEngine.get_fundamentals_many(stock_pool, cache=cache, max_age=max_age, stale_ok=stale_ok)
+        if currency and fx is None:
+            fx = FxTable()
+
         results = []
+        failed = []
         for ticker in stock_pool:
-            data = DataEngine.get_fundamentals(ticker)
-            if data and data['roe'] and data['pe']:
+            data = fetched.get(ticker)
+            if data is None:
+                failed.append(ticker)
+                continue
+            if data['roe'] and data['pe']:
                 # 筛选条件
                 if data['roe'] > min_roe and 0 < data['pe'] < max_pe:
                     # 格式化数据方便前端展示
+                    data = dict(data)
+                    data['currency'] = data.get('currency') or 'USD'
+                    rate = fx.rate(data['currency'], currency) if currency else 1.0
                     data['roe_pct'] = round(data['roe'] * 100, 2)
                     data['pe'] = round(data['pe'], 2)
-                    data['market_cap_b'] = round(data['market_cap'] / 1e9, 2)
+                    data['price_fx'] = round((data['price'] or 0) * rate, 2)
+                    data['market_cap_b'] = round((data['market_cap'] or 0) * rate / 1e9, 2)
                     results.append(data)
 
-        # 返回 DataFrame 方便排序
-        return pd.DataFrame(results) if results else pd.DataFrame()
+        # 返回 DataFrame 方便排序；抓取失败的代码挂在 attrs 上，避免"空结果"和"被限流"混为一谈
+        df = pd.DataFrame(results) if results else pd.DataFrame()
+        df.attrs['failed'] = failed
+        df.attrs['currency'] = currency
+        return df
+
+    @staticmethod
+    def get_price_panel(tickers, period="1y"):
+        """批量下载收盘价/成交量面板 (一次请求)，返回 (close, volume)，均为 日期 × 股票"""
+        with metrics.span("upstream.download", tickers=len(tickers)):
+            raw = UPSTREAM.call("yahoo", yf.download, list(tickers), period=period, auto_adjust=True,
+                                group_by="column", progress=False, threads=True)
+        close, volume = raw["Close"], raw["Volume"]
+        if isinstance(close, pd.Series):  # 只有一只股票时 yfinance 返回 Series
+            close, volume = close.to_frame(tickers[0]), volume.to_frame(tickers[0])
+        return close.sort_index(), volume.sort_index()
 
 
 # ================= 3. 风险雷达层 (Risk Radar Layer) =================
 # ================= 3. 风险雷达层 (Risk Radar Layer) [升级版] =================
 class RiskRadar:
     @staticmethod
-    def analyze_anomalies(ticker):
+    def analyze_anomalies(ticker, hist=None):
         """
         核心风控逻辑：分析单只股票的异常状态
         [升级] 引入 Sigma 系数，用统计学定义“异常”，而非死板的百分比。
+        hist: 可选，调用方已有的 6 个月行情 (含 Close / Volume 列)，传入时不再请求上游
         """
         try:
-            stock = yf.Ticker(ticker)
-            # 获取 6个月数据，为了计算更稳定的 20日/60日 波动率
-            hist = stock.history(period="6mo")
+            if hist is None:
+                stock = yf.Ticker(ticker)
+                # 获取 6个月数据，为了计算更稳定的 20日/60日 波动率
+                with metrics.span("upstream.history", caller="radar"):
+                    hist = UPSTREAM.call("yahoo", stock.history, period="6mo")
 
             if hist.empty or len(hist) < 21:
                 return {"level": "GRAY", "signals": ["数据不足"]}
@@ -190,7 +320,13 @@ class RiskRadar:
                 }
             }
 
+        except CircuitOpenError:
+            metrics.incr("errors", source="radar")
+            return {"symbol": ticker, "level": "GRAY", "signals": ["🔌 数据源熔断中，稍后自动恢复"], "data": {}}
         except Exception as e:
+            metrics.incr("errors", source="radar")
+            if is_rate_limited(e):
+                return {"symbol": ticker, "level": "GRAY", "signals": ["⏳ 数据源限流，重试后仍失败"], "data": {}}
             return {"level": "GRAY", "signals": [f"计算错误: {str(e)}"]}
 
 
@@ -207,38 +343,38 @@ class DeepAnalyzer:
         计算 RSI 相对强弱指标 (无需引入 TA-Lib，纯 Pandas 实现，速度极快)
         原理：比较一段时间内的平均涨幅和平均跌幅。
         """
-        delta = series.diff()
-        gain = (delta.where(delta > 0, 0)).rolling(window=period).mean()
-        loss = (-delta.where(delta < 0, 0)).rolling(window=period).mean()
-
-        rs = gain / loss
-        rsi = 100 - (100 / (1 + rs))
-        return rsi.iloc[-1]  # 只返回最新的 RSI 值
+        return TechnicalFactors.rsi(series, period).iloc[-1]  # 只返回最新的 RSI 值
 
     @staticmethod
+    @metrics.timed("deep_dive.report")
     def get_comprehensive_report(ticker):
-        # 1. 获取基础数据
-        base = DataEngine.get_fundamentals(ticker)
+        # 1. 获取基础数据 (上游失败时用空壳兜底，避免后面 .get 直接崩溃)
+        base = DataEngine.get_fundamentals(ticker) or {"symbol": ticker, "name": ticker, "roe": 0, "pe": None}
 
         # 2. 获取风险数据 (复用现有的 RiskRadar)
-        risk = RiskRadar.analyze_anomalies(ticker)
+        with metrics.span("indicator.radar"):
+            risk = RiskRadar.analyze_anomalies(ticker)
 
         # 3. 获取更详细的财务数据 (yfinance info)
         try:
             stock = yf.Ticker(ticker)
-            info = stock.info
+            with metrics.span("upstream.info", caller="deep_dive"):
+                info = UPSTREAM.call("yahoo", lambda: stock.info)
             # 补充额外指标
             peg = info.get('pegRatio', None)  # 估值神器：PEG
             profit_margin = info.get('profitMargins', 0)  # 净利率
 
             # 计算技术指标 RSI
-            hist = stock.history(period="2mo")  # 取2个月算 RSI 足够了
+            with metrics.span("upstream.history", caller="deep_dive"):
+                hist = UPSTREAM.call("yahoo", stock.history, period="2mo")  # 取2个月算 RSI 足够了
             if not hist.empty and len(hist) > 15:
-                current_rsi = DeepAnalyzer._calculate_rsi(hist['Close'])
+                with metrics.span("indicator.rsi"):
+                    current_rsi = DeepAnalyzer._calculate_rsi(hist['Close'])
             else:
                 current_rsi = 50  # 默认中性
 
         except:
+            metrics.incr("errors", source="deep_dive")
             peg = None
             profit_margin = 0
             current_rsi = 50
@@ -289,7 +425,7 @@ class DeepAnalyzer:
         # 逻辑：不要在下跌趋势接飞刀，不要在历史高点追高
 
         # 1. 波动率惩罚 (基于 Sigma)
-        sigma = risk['data'].get('sigma', 0)
+        sigma = risk.get('data', {}).get('sigma', 0)
         if sigma < 1.5:
             score += 10
             details.append(f"🌊 走势平稳 (Sigma {sigma}σ) [+10]")
@@ -361,10 +497,10 @@ import yfinance as yf
 class NewsEngine:
     @staticmethod
     def get_sentiment_analysis(ticker):
-        print(f"--- [DEBUG] 正在抓取 {ticker} 新闻 ---")
         try:
             stock = yf.Ticker(ticker)
-            news_list = stock.news
+            with metrics.span("upstream.news"):
+                news_list = UPSTREAM.call("yahoo", lambda: stock.news)
 
             if not news_list:
                 return {"score": 0, "suggestion": "暂无新闻数据", "level": "NEUTRAL", "articles": []}
@@ -408,8 +544,9 @@ class NewsEngine:
 
                 if not is_chinese:
                     try:
-                        analysis = TextBlob(title)
-                        polarity = analysis.sentiment.polarity
+                        with metrics.span("indicator.sentiment"):
+                            analysis = TextBlob(title)
+                            polarity = analysis.sentiment.polarity
                         if polarity != 0:
                             valid_articles += 1
 
@@ -418,7 +555,7 @@ class NewsEngine:
                         elif polarity < -0.1:
                             sentiment_icon = "🔴"
                     except:
-                        pass
+                        metrics.incr("errors", source="textblob")
 
                 total_polarity += polarity
 
@@ -454,8 +591,9 @@ class NewsEngine:
             }
 
         except Exception as e:
+            metrics.incr("errors", source="news")
             print(f"!!! [ERROR] NewsEngine 报错: {e}")
-            return {"score": 0, "suggestion": "分析服务异常", "level": "NEUTRAL", "articles": []}
+            return {"score": 0, "suggestion": "分析服务异常", "level": "NEUTRAL", "articles": [], "error": str(e)}
 
 
 # ... (之前的代码保持不变) ...
@@ -498,4 +636,1312 @@ class MarketUniverse:
         return options.get(market_name, [])
 
     #cd exercises
-    #streamlit run app.py
\ No newline at end of file
+    #streamlit run app.py
+
+
+# ================= 7. 基本面快照层 (Fundamentals Snapshot) =================
+# 把整个股票池的基本面落成一张列式表 (DataFrame)，海选时不再逐只实时抓取。
+# 目录下的 *.parquet / *.csv 都会被读入 (可以直接放数千只股票的外部导出文件)，
+# refresh() 定期用 DataEngine 重新抓取并写回 snapshot 文件。
+
+class FundamentalsSnapshot:
+    NUMERIC_COLUMNS = ['price', 'pe', 'peg', 'roe', 'debt_to_equity', 'market_cap',
+                       'profit_margin', 'gross_margin', 'operating_margin']
+
+    def __init__(self, directory="data/fundamentals", max_age_hours=24, shared=None):
+        self.directory = directory
+        self.max_age = max_age_hours * 3600
+        self.shared = shared  # 可选 SharedMarketCache：多进程共用一份内存映射的快照
+        self._frame = None
+        self._signature = None  # 文件列表 + mtime，变化时才重新读盘
+        self._last_attempt = 0.0  # 上次后台刷新的时间，刷新失败时不会每次重跑都再抓一遍
+
+    def _files(self):
+        return sorted(glob.glob(os.path.join(self.directory, "*.parquet")) +
+                      glob.glob(os.path.join(self.directory, "*.csv")))
+
+    def load(self):
+        """读取快照 (内存常驻，文件没变就直接返回)"""
+        files = self._files()
+        signature = tuple((f, os.path.getmtime(f)) for f in files)
+        if self._frame is not None and signature == self._signature:
+            return self._frame
+
+        if self.shared is not None:
+            df = self.shared.get("fundamentals", lambda: {"frame": self._read(files)}, ttl=None,
+                                 stamp=signature)["frame"]
+        else:
+            df = self._read(files)
+        self._frame, self._signature = df, signature
+        return df
+
+    def _read(self, files):
+        with metrics.span("snapshot.load"):
+            frames = [pd.read_parquet(f) if f.endswith(".parquet") else pd.read_csv(f) for f in files]
+            df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['symbol', 'name'])
+            if 'asof' not in df.columns:
+                df['asof'] = 0.0
+            # 同一代码以最新抓取的为准
+            df = df.sort_values('asof').drop_duplicates('symbol', keep='last').reset_index(drop=True)
+            for col in self.NUMERIC_COLUMNS:
+                df[col] = pd.to_numeric(df[col], errors='coerce').astype('float64') if col in df else np.nan
+            # 派生列，方便直接写表达式
+            df['mcap_b'] = df['market_cap'] / 1e9
+            df['roe_pct'] = df['roe'] * 100
+        return df
+
+    def is_stale(self):
+        files = self._files()
+        return not files or time.time() - max(os.path.getmtime(f) for f in files) > self.max_age
+
+    def refresh(self, tickers):
+        """重新抓取 tickers 并写回快照；返回抓取失败的代码"""
+        fetched = DataEngine.get_fundamentals_many(tickers)
+        self.upsert([d for d in fetched.values() if d])
+        return [t for t, d in fetched.items() if not d]
+
+    def refresh_if_stale(self, tickers, retry_after=900):
+        """后台补齐快照 (TTL 驱动)：tickers (宇宙) 与快照现有代码的并集里，超过 max_age 或从没抓过的都重抓；
+        还没有快照时不做 (冷启动由海选 / 手动刷新写入，避免后台全量抓取和前台扫描抢同一份限流额度)。
+        多个会话 / 进程同时触发时只有抢到 refresh 锁的那个去抓。返回是否启动了刷新"""
+        if not self._files() or time.time() - self._last_attempt < retry_after:
+            return False
+        snap = self.load()
+        cutoff = time.time() - self.max_age
+        fresh = set(snap.loc[snap['asof'] >= cutoff, 'symbol'])
+        # 宇宙里从没抓过的代码 + 快照里已有的代码 (含已移出宇宙的)，去掉仍新鲜的
+        expired = [t for t in dict.fromkeys(list(tickers) + snap['symbol'].tolist()) if t not in fresh]
+        if not expired or not self._acquire("refresh", lock_timeout=retry_after):
+            return False
+        self._last_attempt = time.time()
+
+        def run():
+            try:
+                self.refresh(expired)
+            except Exception:
+                metrics.incr("errors", source="snapshot_refresh")
+            finally:
+                self._release("refresh")
+
+        threading.Thread(target=metrics.bind(run), daemon=True, name="snapshot-refresh").start()
+        return True
+
+    def _acquire(self, name, lock_timeout=60):
+        """跨进程文件锁：O_EXCL 创建 {name}.lock，写者崩溃留下的锁超过 lock_timeout 视为失效"""
+        path = os.path.join(self.directory, f"{name}.lock")
+        for _ in range(2):
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(path) < lock_timeout:
+                        return False
+                    os.remove(path)
+                except OSError:
+                    pass
+        return False
+
+    def _release(self, name):
+        try:
+            os.remove(os.path.join(self.directory, f"{name}.lock"))
+        except OSError:
+            pass
+
+    _write_lock = threading.Lock()
+
+    def upsert(self, rows, wait_timeout=120):
+        """把新抓取的基本面合并进 snapshot 文件 (同一代码保留最新一条)。
+        读-合并-写整个过程持有 write 文件锁，多个进程同时写也不会互相覆盖掉对方的新行"""
+        if not rows:
+            return
+        new = pd.DataFrame(rows)
+        new['asof'] = time.time()
+        os.makedirs(self.directory, exist_ok=True)
+        with FundamentalsSnapshot._write_lock:
+            deadline = time.time() + wait_timeout
+            while not self._acquire("write"):
+                if time.time() > deadline:
+                    raise TimeoutError("snapshot write lock busy")
+                time.sleep(0.05)
+            try:
+                self._merge_write(new)
+            finally:
+                self._release("write")
+
+    def _merge_write(self, new):
+        try:
+            path = os.path.join(self.directory, "snapshot.parquet")
+            tmp = f"{path}.{os.getpid()}.tmp"
+            old = pd.read_parquet(path) if os.path.exists(path) else None
+            merged = pd.concat([old, new], ignore_index=True) if old is not None else new
+            merged = merged.drop_duplicates('symbol', keep='last')
+            merged.to_parquet(tmp, index=False)
+        except ImportError:  # 没装 pyarrow 时退回 CSV
+            path = os.path.join(self.directory, "snapshot.csv")
+            tmp = f"{path}.{os.getpid()}.tmp"
+            old = pd.read_csv(path) if os.path.exists(path) else None
+            merged = pd.concat([old, new], ignore_index=True) if old is not None else new
+            merged = merged.drop_duplicates('symbol', keep='last')
+            merged.to_csv(tmp, index=False)
+        os.replace(tmp, path)  # 原子替换，读者不会读到半截文件
+
+
+# ================= 8. 表达式筛选引擎 (Screener Query Engine) =================
+# 例: where = "roe > 0.15 and 0 < pe < 30 and (peg < 1.5 or de < 50)"
+#     order_by = "-roe, pe"   (每一项都是表达式，按升序排；加负号即降序)
+# 表达式先用 ast 做白名单校验，再直接在 NumPy 列上向量化求值，不走 eval。
+
+class ScreenerQuery:
+    ALIASES = {
+        'de': 'debt_to_equity', 'mcap': 'market_cap', 'margin': 'profit_margin',
+        'net_margin': 'profit_margin', 'gross': 'gross_margin', 'op_margin': 'operating_margin',
+    }
+
+    _BIN_OPS = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.divide,
+                ast.BitAnd: np.logical_and, ast.BitOr: np.logical_or}
+    _CMP_OPS = {ast.Gt: np.greater, ast.GtE: np.greater_equal, ast.Lt: np.less, ast.LtE: np.less_equal,
+                ast.Eq: np.equal, ast.NotEq: np.not_equal}
+
+    @staticmethod
+    def _resolve(name, df):
+        col = ScreenerQuery.ALIASES.get(name, name)
+        if col not in df.columns or not pd.api.types.is_numeric_dtype(df[col]):
+            raise ValueError(f"未知字段: {name}")
+        return df[col].to_numpy(dtype='float64')
+
+    @staticmethod
+    def _eval(node, df):
+        Q = ScreenerQuery
+        if isinstance(node, ast.Expression):
+            return Q._eval(node.body, df)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return node.value
+        if isinstance(node, ast.Name):
+            return Q._resolve(node.id, df)
+        if isinstance(node, ast.BoolOp):
+            op = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            return op.reduce([np.asarray(Q._eval(v, df), dtype=bool) for v in node.values])
+        if isinstance(node, ast.UnaryOp):
+            val = Q._eval(node.operand, df)
+            if isinstance(node.op, (ast.Not, ast.Invert)):
+                return np.logical_not(val)
+            if isinstance(node.op, ast.USub):
+                return np.negative(val)
+        if isinstance(node, ast.BinOp) and type(node.op) in Q._BIN_OPS:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return Q._BIN_OPS[type(node.op)](Q._eval(node.left, df), Q._eval(node.right, df))
+        if isinstance(node, ast.Compare) and all(type(op) in Q._CMP_OPS for op in node.ops):
+            # 支持链式比较 0 < pe < 30；NaN 参与比较恒为 False，缺数据的股票自然被过滤
+            left = Q._eval(node.left, df)
+            mask = np.ones(len(df), dtype=bool)
+            for op, comp in zip(node.ops, node.comparators):
+                right = Q._eval(comp, df)
+                mask &= Q._CMP_OPS[type(op)](left, right)
+                left = right
+            return mask
+        raise ValueError(f"不支持的表达式: {ast.dump(node)[:60]}")
+
+    @staticmethod
+    def evaluate(df, expr):
+        """返回与 df 等长的布尔/数值数组"""
+        try:
+            tree = ast.parse(expr.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ValueError(f"表达式语法错误: {e.msg}")
+        except (RecursionError, MemoryError):
+            raise ValueError("表达式嵌套过深")
+        try:
+            result = ScreenerQuery._eval(tree, df)
+        except RecursionError:
+            raise ValueError("表达式嵌套过深")
+        return np.broadcast_to(result, (len(df),))
+
+    @staticmethod
+    def run(df, where="", order_by="", limit=None):
+        """执行 where 过滤 + order_by 排序"""
+        with metrics.span("screener.query"):
+            if where.strip():
+                df = df[np.asarray(ScreenerQuery.evaluate(df, where), dtype=bool)]
+            keys = [k.strip() for k in order_by.split(",") if k.strip()]
+            if keys and not df.empty:
+                sort_cols = [ScreenerQuery.evaluate(df, k) for k in keys]
+                # np.lexsort 以最后一个键为主键；NaN 排在最后
+                order = np.lexsort([np.nan_to_num(c, nan=np.inf) for c in reversed(sort_cols)])
+                df = df.iloc[order]
+            if limit:
+                df = df.head(limit)
+            return df.reset_index(drop=True)
+
+
+# ================= 9. 技术因子层 (Technical Factors) =================
+# 与 RiskRadar / DeepAnalyzer 的口径完全一致，但输出整条时间序列。
+# 所有方法既接受 Series (单只股票)，也接受 DataFrame (日期 × 股票 面板)，
+# 全部是 pandas 列向量运算，回测时一次算完整个面板。
+
+class TechnicalFactors:
+    LEVEL_GREEN, LEVEL_YELLOW, LEVEL_RED = 0, 1, 2
+
+    @staticmethod
+    def rsi(close, period=14):
+        """RSI (简单均线版，与原 _calculate_rsi 一致)"""
+        delta = close.diff()
+        gain = (delta.where(delta > 0, 0)).rolling(window=period).mean()
+        loss = (-delta.where(delta < 0, 0)).rolling(window=period).mean()
+        rs = gain / loss
+        return 100 - (100 / (1 + rs))
+
+    @staticmethod
+    def sigma(close, window=20):
+        """Sigma = |今日涨跌幅| / 截至昨日的 20 日波动率"""
+        ret = close.pct_change()
+        base = ret.rolling(window=window).std().shift(1)
+        sig = ret.abs() / base
+        return sig.where((base > 0) & base.notna(), 0.0)
+
+    @staticmethod
+    def volume_ratio(volume, window=20):
+        return volume / (volume.rolling(window=window).mean() + 1)
+
+    @staticmethod
+    def radar_level(close, volume):
+        """
+        RiskRadar 信号的时间序列版：0=GREEN, 1=YELLOW, 2=RED，数据不足 (<21 根K线) 为 NaN
+        """
+        ret = close.pct_change()
+        sig = TechnicalFactors.sigma(close)
+        vol_ratio = TechnicalFactors.volume_ratio(volume)
+        ma60 = close.rolling(window=60).mean()
+
+        red = (sig > 3.0) | (ret < -0.07) | (vol_ratio > 3.0)
+        yellow = (sig > 2.0) | (vol_ratio > 1.8) | (close < ma60 * 0.97)
+
+        level = red * TechnicalFactors.LEVEL_RED + (~red & yellow) * TechnicalFactors.LEVEL_YELLOW
+        bars = close.notna().cumsum()
+        return level.astype('float64').where(bars >= 21)
+
+
+# ================= 10. 组合风险层 (Portfolio Risk Layer) =================
+# 把关注池当成一个组合来看：滚动协方差 (Ledoit-Wolf 收缩)、组合波动率、
+# 历史 VaR / ES、以及"同涨同跌"的股票簇。
+# 协方差用滚动窗口内的 Σx 与 Σxxᵀ 增量维护：新 K 线到来只做 O(n²) 的加减，不重算整个窗口。
+
+class PortfolioRisk:
+    def __init__(self, window=250):
+        self.window = window
+        self.tickers = None
+        self.last_date = None
+        self._lock = threading.RLock()  # 实例经 st.cache_resource 在会话间共享，累加量的读写都要加锁
+        self._reset([])
+
+    def _reset(self, tickers):
+        n = len(tickers)
+        self.tickers = list(tickers)
+        self.last_date = None
+        self._rows = deque()
+        self._sum = np.zeros(n)
+        self._sum_xx = np.zeros((n, n))
+        self._updates = 0
+
+    def _rebuild(self):
+        """定期用窗口原始数据重算累加量，消除反复加减的浮点漂移"""
+        X = np.asarray(self._rows)
+        self._sum = X.sum(axis=0)
+        self._sum_xx = X.T @ X
+        self._updates = 0
+
+    def update(self, close):
+        """喂入收盘价面板 (日期 × 股票)；只累加上次之后的新 K 线，返回新增条数"""
+        close = close.sort_index()
+        # 跨市场的关注池各自有休市日：先前向填充价格，休市那天记 0 收益，复市后的涨跌完整算在复市当天
+        rets = close.ffill().pct_change(fill_method=None).iloc[1:]
+        with self._lock:
+            if list(close.columns) != self.tickers:
+                self._reset(close.columns)
+            if self.last_date is not None:
+                # 上次消费的最后一根可能是盘中未完成的 K 线，或另一个市场还没收盘 (前向填充成 0 收益)：
+                # 先把它从累加量里减掉，再和新数据一起重新累加
+                rets = rets[rets.index >= self.last_date]
+                if rets.empty:
+                    return 0
+                if rets.index[0] == self.last_date and self._rows:
+                    old = self._rows.pop()
+                    self._sum -= old
+                    self._sum_xx -= np.outer(old, old)
+            if rets.empty:
+                return 0
+
+            with metrics.span("risk.update", tickers=len(self.tickers)):
+                X = np.nan_to_num(rets.to_numpy(dtype='float64')[-self.window:])  # 上市前 / 缺数据按 0 收益处理
+                self._sum += X.sum(axis=0)
+                self._sum_xx += X.T @ X
+                self._rows.extend(X)
+                while len(self._rows) > self.window:
+                    old = self._rows.popleft()
+                    self._sum -= old
+                    self._sum_xx -= np.outer(old, old)
+                self._updates += len(X)
+                if self._updates >= self.window:
+                    self._rebuild()
+            self.last_date = rets.index[-1]
+            return len(X)
+
+    def returns(self):
+        with self._lock:
+            return np.asarray(self._rows)
+
+    def covariance(self, shrink=True):
+        """
+        日频协方差矩阵。shrink=True 时向 μI 做 Ledoit-Wolf 收缩 (小样本、多股票时更稳定)
+        返回 (cov DataFrame, 收缩强度)
+        """
+        with self._lock:
+            X = self.returns()
+            T = len(X)
+            if T < 2:
+                raise ValueError("数据不足，无法计算协方差")
+            mean = self._sum / T
+            S = self._sum_xx / T - np.outer(mean, mean)
+            tickers = list(self.tickers)
+        delta = 0.0
+        if shrink:
+            n = S.shape[0]
+            Xc = X - mean
+            mu = np.trace(S) / n
+            d2 = np.sum((S - mu * np.eye(n)) ** 2) / n
+            # mean_t ||x_t x_tᵀ - S||² = mean ||x||⁴ - 2 mean xᵀSx + ||S||²，避免生成 T×n×n 的张量
+            sq = np.sum(Xc * Xc, axis=1)
+            pi = np.mean(sq ** 2) - 2 * np.mean(np.sum((Xc @ S) * Xc, axis=1)) + np.sum(S * S)
+            b2 = min(pi / T / n, d2)
+            delta = b2 / d2 if d2 > 0 else 0.0
+            S = delta * mu * np.eye(n) + (1 - delta) * S
+        return pd.DataFrame(S, index=tickers, columns=tickers), round(float(delta), 4)
+
+    def correlation(self, shrink=True):
+        cov, _ = self.covariance(shrink)
+        std = np.sqrt(np.diag(cov.to_numpy()))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr = cov.to_numpy() / np.outer(std, std)
+        return pd.DataFrame(np.nan_to_num(corr), index=cov.index, columns=cov.columns)
+
+    def portfolio(self, weights=None, alpha=0.95):
+        """组合年化波动率 + 历史模拟 VaR / ES (日频，正数表示损失)"""
+        with self._lock:  # 协方差和收益序列取自同一版窗口
+            cov, delta = self.covariance()
+            port_rets = self.returns()
+        n = len(cov)
+        w = np.full(n, 1.0 / n) if weights is None else np.asarray(weights, dtype='float64')
+        port = port_rets @ w
+        var = -np.quantile(port, 1 - alpha)
+        tail = port[port <= -var]
+        return {
+            "annual_vol": float(np.sqrt(w @ cov.to_numpy() @ w * 252)),
+            "var": float(var),
+            "es": float(-tail.mean()) if len(tail) else float(var),
+            "alpha": alpha,
+            "shrinkage": delta,
+            "observations": len(port),
+        }
+
+    def clusters(self, threshold=0.6):
+        """
+        平均连接 (average linkage) 层次聚类：相关系数高于 threshold 的股票逐步合并成簇。
+        相似度矩阵用 Lance-Williams 公式就地更新，每次合并 O(n²)。
+        """
+        corr_df = self.correlation()
+        tickers = list(corr_df.index)
+        corr = corr_df.to_numpy().copy()
+        n = len(tickers)
+        members = {i: [i] for i in range(n)}
+        np.fill_diagonal(corr, -np.inf)
+        active = np.ones(n, dtype=bool)
+        while active.sum() > 1:
+            masked = np.where(np.outer(active, active), corr, -np.inf)
+            i, j = np.unravel_index(np.argmax(masked), masked.shape)
+            if masked[i, j] < threshold:
+                break
+            ni, nj = len(members[i]), len(members[j])
+            corr[i, :] = corr[:, i] = (ni * corr[i, :] + nj * corr[j, :]) / (ni + nj)
+            corr[i, i] = -np.inf
+            members[i] += members.pop(j)
+            active[j] = False
+        groups = [[tickers[k] for k in idx] for idx in members.values() if len(idx) > 1]
+        return sorted(groups, key=len, reverse=True)
+
+
+# ================= 11. 本地行情缓存 (History Cache) =================
+# 日线历史落盘到 data/history/{ticker}.pkl，过期后只增量拉取最后一段。
+# 日内数据 (1D/5D) 不落盘，只在内存里缓存一分钟。
+
+class HistoryCache:
+    def __init__(self, directory="data/history", ttl_minutes=30, initial_period="10y"):
+        self.directory = directory
+        self.ttl = ttl_minutes * 60
+        self.initial_period = initial_period
+        self._memory = {}  # ticker -> (mtime, DataFrame)
+        self._intraday = {}  # (ticker, period, interval) -> (timestamp, DataFrame)
+        self._lock = threading.Lock()
+
+    def _path(self, ticker):
+        return os.path.join(self.directory, f"{ticker.replace('/', '_')}.pkl")
+
+    def _read(self, ticker):
+        path = self._path(ticker)
+        if not os.path.exists(path):
+            return None, 0.0
+        mtime = os.path.getmtime(path)
+        cached = self._memory.get(ticker)
+        if cached and cached[0] == mtime:
+            return cached[1], mtime
+        df = pd.read_pickle(path)
+        self._memory[ticker] = (mtime, df)
+        return df, mtime
+
+    def get_daily(self, ticker):
+        """完整日线 (最长 initial_period)，命中缓存时不访问网络"""
+        with self._lock:
+            df, mtime = self._read(ticker)
+        if df is not None and time.time() - mtime < self.ttl:
+            metrics.incr("cache_hit", cache="history")
+            return df
+
+        metrics.incr("cache_miss", cache="history")
+        stock = yf.Ticker(ticker)
+        with metrics.span("upstream.history", caller="history_cache"):
+            if df is None or len(df) < 2:
+                df, fresh = None, UPSTREAM.call("yahoo", stock.history, period=self.initial_period)
+            else:
+                # 增量：从倒数第二根 K 线开始补 (最后一根可能是盘中未完成的，需要覆盖)
+                fresh = UPSTREAM.call("yahoo", stock.history, start=df.index[-2].strftime("%Y-%m-%d"))
+                # 倒数第二根是已收盘的 K 线，收盘价对不上说明中间发生了拆股 / 分红，缓存里的复权价已经过时
+                anchor = df.index[-2]
+                if fresh is not None and anchor in fresh.index and \
+                        not np.isclose(fresh.at[anchor, 'Close'], df.at[anchor, 'Close'], rtol=1e-4):
+                    metrics.incr("history_readjusted")
+                    df, fresh = None, UPSTREAM.call("yahoo", stock.history, period=self.initial_period)
+        if fresh is None or fresh.empty:
+            return df if df is not None else pd.DataFrame()
+
+        merged = fresh if df is None else pd.concat([df, fresh])
+        merged = merged[~merged.index.duplicated(keep='last')].sort_index()
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(ticker)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"  # 多线程 / 多进程同时刷新同一只互不踩临时文件
+        merged.to_pickle(tmp)
+        os.replace(tmp, path)
+        with self._lock:
+            self._memory[ticker] = (os.path.getmtime(path), merged)
+        return merged
+
+    def get_intraday(self, ticker, period="1d", interval="5m", ttl=60):
+        key = (ticker, period, interval)
+        hit = self._intraday.get(key)
+        if hit and time.time() - hit[0] < ttl:
+            return hit[1]
+        with metrics.span("upstream.history", caller="intraday"):
+            df = UPSTREAM.call("yahoo", yf.Ticker(ticker).history, period=period, interval=interval)
+        self._intraday[key] = (time.time(), df)
+        return df
+
+
+# ================= 12. 图表引擎 (Chart Engine) =================
+# 多区间走势图：数据来自 HistoryCache，长区间在服务端降采样到固定点数，
+# 所以 10 年图和 6 个月图发给前端的点数一样多。
+
+class ChartEngine:
+    # 区间 -> 日线回看长度；元组表示走日内接口 (period, interval)
+    RANGES = {
+        "1D": ("1d", "5m"), "5D": ("5d", "30m"),
+        "1M": pd.DateOffset(months=1), "3M": pd.DateOffset(months=3), "6M": pd.DateOffset(months=6),
+        "1Y": pd.DateOffset(years=1), "3Y": pd.DateOffset(years=3), "5Y": pd.DateOffset(years=5),
+        "10Y": pd.DateOffset(years=10),
+    }
+
+    @staticmethod
+    def lttb(x, y, n_out):
+        """
+        Largest-Triangle-Three-Buckets 降采样，返回保留点的下标。
+        每个桶选出与 (上一个已选点, 下一个桶均值) 构成三角形面积最大的点，能保住尖峰和拐点。
+        """
+        n = len(x)
+        if n_out >= n or n_out < 3:
+            return np.arange(n)
+        edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+        idx = np.empty(n_out, dtype=int)
+        idx[0], idx[-1] = 0, n - 1
+        a = 0
+        for i in range(n_out - 2):
+            start, end = edges[i], edges[i + 1]
+            nxt_end = edges[i + 2] if i + 2 < len(edges) else n
+            avg_x, avg_y = x[end:nxt_end].mean(), y[end:nxt_end].mean()
+            xs, ys = x[start:end], y[start:end]
+            area = np.abs((x[a] - avg_x) * (ys - y[a]) - (x[a] - xs) * (avg_y - y[a]))
+            a = start + int(np.argmax(area))
+            idx[i + 1] = a
+        return idx
+
+    @staticmethod
+    def minmax(y, n_out):
+        """Min/Max 分桶：每个桶保留最低点和最高点，返回排好序的下标"""
+        n = len(y)
+        if n_out >= n or n_out < 2:
+            return np.arange(n)
+        buckets = max(1, n_out // 2)
+        edges = np.linspace(0, n, buckets + 1).astype(int)
+        keep = set()
+        for start, end in zip(edges[:-1], edges[1:]):
+            if end > start:
+                seg = y[start:end]
+                keep.update((start + int(np.argmin(seg)), start + int(np.argmax(seg))))
+        return np.array(sorted(keep))
+
+    @staticmethod
+    def build(ticker, range_key="6M", budget=500, method="lttb", cache=None):
+        """
+        返回 (line_df, markers_df)：
+            line_df    —— 降采样后的收盘价 [Date, Close]
+            markers_df —— 区间内 RiskRadar 判为 RED 的交易日 [Date, Close, Sigma, Return]
+        """
+        cache = cache or HistoryCache()
+        spec = ChartEngine.RANGES[range_key]
+        with metrics.span("chart.build", range=range_key):
+            if isinstance(spec, tuple):
+                hist = cache.get_intraday(ticker, *spec)
+                full = None
+            else:
+                full = cache.get_daily(ticker)
+                hist = full[full.index >= full.index[-1] - spec] if not full.empty else full
+            if hist is None or hist.empty:
+                return pd.DataFrame(columns=['Date', 'Close']), pd.DataFrame(columns=['Date', 'Close', 'Sigma', 'Return'])
+
+            close = hist['Close'].to_numpy(dtype='float64')
+            x = hist.index.asi8.astype('float64')
+            idx = ChartEngine.lttb(x, close, budget) if method == "lttb" else ChartEngine.minmax(close, budget)
+            line = pd.DataFrame({'Date': hist.index[idx], 'Close': close[idx]})
+
+            markers = pd.DataFrame(columns=['Date', 'Close', 'Sigma', 'Return'])
+            if full is not None:
+                # 在完整历史上算信号 (保证区间开头的滚动窗口是满的)，再截取到当前区间
+                level = TechnicalFactors.radar_level(full['Close'], full['Volume']).reindex(hist.index)
+                sigma = TechnicalFactors.sigma(full['Close']).reindex(hist.index)
+                ret = full['Close'].pct_change().reindex(hist.index)
+                red = (level == TechnicalFactors.LEVEL_RED).to_numpy()
+                markers = pd.DataFrame({'Date': hist.index[red], 'Close': close[red],
+                                        'Sigma': sigma[red].round(2).to_numpy(),
+                                        'Return': (ret[red] * 100).round(2).to_numpy()})
+                # 标记点也受点数预算约束：太多时只保留最极端的
+                if len(markers) > budget // 5:
+                    markers = markers.nlargest(budget // 5, 'Sigma').sort_values('Date')
+        return line, markers
+
+
+# ================= 13. 变化侦测与告警 (Change Detection & Alerts) =================
+# 每次刷新给关注池里的每只股票拍一张快照 (雷达灯 / 评分 / 评级 / 舆情)，与上一次对比产出告警。
+# 输入没变的股票 (最新 K 线相同) 直接沿用上次结果，不重新跑评分和新闻抓取。
+
+class FileAlertSink:
+    """告警追加写入 JSON Lines 文件，侧边栏告警流从这里读；超过 max_bytes 轮转成 .1"""
+
+    def __init__(self, path="data/alerts.jsonl", max_bytes=5 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def send(self, alerts):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        try:
+            if os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + ".1")
+        except OSError:
+            pass
+        with open(self.path, "a", encoding="utf-8") as f:
+            for a in alerts:
+                f.write(json.dumps(a, ensure_ascii=False) + "\n")
+
+    def recent(self, n=20, block=8192):
+        """从文件末尾往前按块读，凑够 n 行就停 (侧边栏每次渲染都调用，不读整个文件)"""
+        try:
+            f = open(self.path, "rb")
+        except OSError:
+            return []
+        with f:
+            f.seek(0, os.SEEK_END)
+            pos, data = f.tell(), b""
+            while pos > 0 and data.count(b"\n") <= n:
+                step = min(block, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+        lines = [l for l in data.decode("utf-8", errors="ignore").splitlines() if l.strip()]
+        if pos > 0:
+            lines = lines[1:]  # 第一行可能只读到半截
+        return [json.loads(l) for l in reversed(lines[-n:])]
+
+
+class WebhookAlertSink:
+    """把一批告警 POST 到 webhook (本地可用 alert_stub.py 接收)"""
+
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, alerts):
+        body = json.dumps({"alerts": alerts}, ensure_ascii=False).encode("utf-8")
+        req = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        try:
+            with metrics.span("alerts.webhook"):
+                urllib.request.urlopen(req, timeout=self.timeout).close()
+        except Exception as e:
+            metrics.incr("errors", source="alert_webhook")
+            print(f"Alert webhook failed: {e}")
+
+
+class WatchlistMonitor:
+    LEVEL_RANK = {"GRAY": -1, "GREEN": 0, "YELLOW": 1, "RED": 2}
+
+    FUNDAMENTAL_INPUTS = ('roe', 'pe', 'peg', 'profit_margin')
+
+    def __init__(self, state_path="data/watchlist_state.json", sinks=None, score_threshold=10,
+                 history_cache=None, fundamentals=None, shared=None, news_ttl=3600):
+        self.state_path = state_path
+        self.sinks = sinks if sinks is not None else [FileAlertSink()]
+        self.score_threshold = score_threshold
+        self.history_cache = history_cache or HistoryCache()
+        self.fundamentals = fundamentals  # 可选 FundamentalsSnapshot：评分用到的基本面也进指纹
+        self.shared = shared  # 可选 SharedMarketCache：整个关注池的行情面板 (和雷达共用同一份)
+        self.news_ttl = news_ttl  # 新闻没有本地缓存：每只股票至少每 news_ttl 秒完整重算一次，捕捉舆情变化
+        self._lock = threading.Lock()  # 实例在会话间共享，state 的读改写要串行
+        self.state = self._load()
+
+    def _load(self):
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        with open(self.state_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def fingerprint(self, ticker, bars=None):
+        """
+        输入指纹，全部来自本地缓存：最新一根日线 (日期/收盘/成交量) + 快照里该股票的 asof 与评分用基本面
+        + 新闻时间片 (每 news_ttl 秒换一次)。bars: 共享面板里该股票的 (close, volume)，没有时读 HistoryCache。
+        拿不到数据时返回 None (强制重算)
+        """
+        try:
+            if bars is not None:
+                close, volume = bars[0].dropna(), bars[1]
+            else:
+                hist = self.history_cache.get_daily(ticker)
+                close, volume = hist['Close'], hist['Volume']
+        except Exception:
+            return None
+        if close is None or close.empty:
+            return None
+        date = close.index[-1]
+        parts = [f"{date}|{close.iloc[-1]:.4f}|{volume.get(date, 0):.0f}", str(int(time.time() // self.news_ttl))]
+        if self.fundamentals is not None:
+            snap = self.fundamentals.load()
+            row = snap[snap['symbol'] == ticker] if 'symbol' in snap else snap.iloc[:0]
+            if len(row):
+                parts.append("|".join(f"{row[c].iloc[-1]:.6g}" for c in ('asof',) + self.FUNDAMENTAL_INPUTS
+                                      if c in row))
+        return hashlib.sha1("\n".join(parts).encode()).hexdigest()[:16]
+
+    @staticmethod
+    def snapshot(ticker):
+        """完整重算一只股票的状态；基本面或新闻拿不到时返回 None。
+        雷达变 GRAY (行情没数据) 是要报出来的状态，不算失败"""
+        report = DeepAnalyzer.get_comprehensive_report(ticker)
+        news = NewsEngine.get_sentiment_analysis(ticker)
+        if "price" not in report["base"] or "error" in news:
+            metrics.incr("monitor_failed")
+            return None
+        return {
+            "level": report["risk"].get("level", "GRAY"),
+            "score": report["ai_score"],
+            "rating": report["rating"],
+            "sentiment": news["level"],
+        }
+
+    def diff(self, ticker, old, new):
+        """对比两次快照，返回告警列表"""
+        alerts = []
+        ts = datetime.now().isoformat(timespec="seconds")
+
+        def alert(kind, before, after, message, severity="info"):
+            alerts.append({"ts": ts, "ticker": ticker, "type": kind, "from": before, "to": after,
+                           "message": message, "severity": severity})
+
+        if old["level"] != new["level"]:
+            worse = self.LEVEL_RANK.get(new["level"], -1) > self.LEVEL_RANK.get(old["level"], -1)
+            # 变成 GRAY = 这只股票取不到行情了，同样要提醒
+            severity = "critical" if new["level"] == "RED" else ("warning" if worse or new["level"] == "GRAY" else "info")
+            alert("level", old["level"], new["level"], f"{ticker} 雷达 {old['level']} → {new['level']}", severity)
+        delta = new["score"] - old["score"]
+        if abs(delta) >= self.score_threshold:
+            alert("score", old["score"], new["score"], f"{ticker} 评分 {old['score']} → {new['score']} ({delta:+d})",
+                  "warning" if delta < 0 else "info")
+        if old["rating"] != new["rating"]:
+            alert("rating", old["rating"], new["rating"], f"{ticker} 评级 {old['rating']} → {new['rating']}")
+        if old["sentiment"] != new["sentiment"]:
+            alert("sentiment", old["sentiment"], new["sentiment"],
+                  f"{ticker} 舆情 {old['sentiment']} → {new['sentiment']}",
+                  "warning" if new["sentiment"] == "NEGATIVE" else "info")
+        return alerts
+
+    def refresh(self, tickers):
+        """增量刷新：只重算指纹变化的股票；返回 (本次告警, 重算的股票列表)"""
+        close = volume = None
+        if self.shared is not None:
+            try:
+                close, volume = self.shared.get_panel(tickers, period="6mo")
+            except Exception:
+                pass  # 共享面板取不到时退回逐只读 HistoryCache
+
+        def fingerprint(ticker):
+            if close is not None and ticker in close.columns:
+                return self.fingerprint(ticker, (close[ticker], volume[ticker]))
+            return self.fingerprint(ticker)
+
+        with ThreadPoolExecutor(max_workers=UPSTREAM.max_concurrency) as pool:
+            prints = dict(zip(tickers, pool.map(metrics.bind(fingerprint), tickers)))
+        with self._lock:
+            changed = [t for t in tickers
+                       if prints[t] is None or self.state.get(t, {}).get("fingerprint") != prints[t]]
+        metrics.incr("monitor_skipped", value=len(tickers) - len(changed))
+
+        with ThreadPoolExecutor(max_workers=UPSTREAM.max_concurrency) as pool:
+            snaps = dict(zip(changed, pool.map(metrics.bind(self.snapshot), changed)))
+
+        alerts = []
+        with self._lock:
+            for ticker, snap in snaps.items():
+                if snap is None:
+                    continue  # 临时失败：不告警，也不覆盖上一次的基线，下次再算
+                old = self.state.get(ticker)
+                if old:
+                    alerts.extend(self.diff(ticker, old, snap))
+                self.state[ticker] = dict(snap, fingerprint=prints[ticker], ts=time.time())
+            # 移出关注池的股票不再跟踪
+            for ticker in set(self.state) - set(tickers):
+                del self.state[ticker]
+            self._save()
+
+        if alerts:
+            metrics.incr("alerts", value=len(alerts))
+            for sink in self.sinks:
+                sink.send(alerts)
+        return alerts, changed
+
+
+
+# ================= 14. 跨进程共享行情缓存 (Shared Market Cache) =================
+# 多个 Streamlit 进程共用一份行情面板 / 基本面快照：
+#   - 数据以 .npy 落在 data/shared/{name}/v{版本}/ 下，读取时 np.load(mmap_mode="r")，
+#     DataFrame 直接建在内存映射上 (零拷贝)，各进程共享同一份操作系统页缓存；
+#   - 每个数据集只有一个写者：用 O_EXCL 创建 .lock 文件抢锁，抢到的进程负责抓取并写新版本，
+#     其余进程继续读旧版本 (没有旧版本就等待)，所以上游请求数不随进程数增长；
+#   - manifest.json 原子替换，读者要么看到旧版本、要么看到完整的新版本。
+# 只有数值列是零拷贝的；字符串列 (代码、名称、币种) 体量很小，读入时转换成普通列。
+
+class SharedMarketCache:
+    def __init__(self, directory="data/shared", ttl=300, lock_timeout=120, wait_timeout=60, retry_after=60,
+                 max_idle=86400):
+        self.directory = directory
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout  # 写者崩溃留下的锁，超过这个时间视为失效
+        self.wait_timeout = wait_timeout
+        self.retry_after = retry_after  # 重建失败后这段时间内直接抛出上次的错误，不再打上游
+        self.max_idle = max_idle  # 超过这个时间没有重写的 panel_* 数据集会被清理
+        self._opened = {}  # name -> (version, frames)，同一版本只映射一次
+        self._failures = {}  # name -> (时间, 异常)
+        self._last_prune = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _manifest(self, name):
+        try:
+            with open(os.path.join(self.directory, name, "manifest.json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _fresh(self, entry, ttl, stamp):
+        if entry is None or entry.get("stamp") != stamp:
+            return False
+        return ttl is None or time.time() - entry["created"] < ttl
+
+    def _acquire(self, name):
+        path = os.path.join(self.directory, f"{name}.lock")
+        for _ in range(2):
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(path) < self.lock_timeout:
+                        return False
+                    os.remove(path)  # 失效的锁，清掉后再抢一次
+                except OSError:
+                    pass
+        return False
+
+    def _release(self, name):
+        try:
+            os.remove(os.path.join(self.directory, f"{name}.lock"))
+        except OSError:
+            pass
+
+    @staticmethod
+    def _dump(folder, key, df):
+        """数值列存成一个二维 float64 矩阵；字符串列单独存；索引按日期 / 字符串 / 默认区分"""
+        numeric = [c for c in df.columns if pd.api.types.is_numeric_dtype(df[c])]
+        strings = [c for c in df.columns if c not in numeric]
+        np.save(os.path.join(folder, f"{key}.values.npy"), df[numeric].to_numpy(dtype="float64"))
+        for i, col in enumerate(strings):
+            np.save(os.path.join(folder, f"{key}.s{i}.npy"), df[col].fillna("").astype(str).to_numpy(dtype="U"))
+
+        meta = {"columns": [str(c) for c in numeric], "strings": [str(c) for c in strings], "tz": None}
+        if isinstance(df.index, pd.DatetimeIndex):
+            meta["index"] = "datetime"
+            meta["tz"] = str(df.index.tz) if df.index.tz is not None else None
+            np.save(os.path.join(folder, f"{key}.index.npy"), df.index.asi8)
+        elif isinstance(df.index, pd.RangeIndex):
+            meta["index"] = "range"
+        else:
+            meta["index"] = "string"
+            np.save(os.path.join(folder, f"{key}.index.npy"), df.index.astype(str).to_numpy(dtype="U"))
+        return meta
+
+    @staticmethod
+    def _load(folder, key, meta):
+        values = np.load(os.path.join(folder, f"{key}.values.npy"), mmap_mode="r")
+        if meta["index"] == "range":
+            index = None
+        else:
+            raw = np.load(os.path.join(folder, f"{key}.index.npy"), mmap_mode="r")
+            if meta["index"] == "datetime":
+                index = pd.DatetimeIndex(np.asarray(raw).view("datetime64[ns]"))
+                if meta["tz"]:
+                    index = index.tz_localize("UTC").tz_convert(meta["tz"])
+            else:
+                index = pd.Index(np.asarray(raw).astype(str))
+        df = pd.DataFrame(values, index=index, columns=meta["columns"], copy=False)
+        for i, col in enumerate(meta["strings"]):
+            df[col] = np.load(os.path.join(folder, f"{key}.s{i}.npy")).astype(object)
+        return df
+
+    def _write(self, name, frames, stamp):
+        base = os.path.join(self.directory, name)
+        version = f"v{time.time_ns()}"
+        folder = os.path.join(base, version)
+        os.makedirs(folder, exist_ok=True)
+        with metrics.span("shared_cache.write", dataset=name):
+            entry = {"version": version, "created": time.time(), "stamp": stamp,
+                     "frames": {key: self._dump(folder, key, df) for key, df in frames.items()}}
+        tmp = os.path.join(base, "manifest.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp, os.path.join(base, "manifest.json"))
+        # 只保留当前和上一个版本；其他进程可能还映射着上一个版本
+        versions = sorted(v for v in os.listdir(base) if v.startswith("v"))
+        for old in versions[:-2]:
+            for fn in glob.glob(os.path.join(base, old, "*")):
+                try:
+                    os.remove(fn)
+                except OSError:  # Windows 下仍被映射的文件删不掉，下次再清
+                    pass
+            try:
+                os.rmdir(os.path.join(base, old))
+            except OSError:
+                pass
+        if time.time() - self._last_prune > 3600:
+            self.prune()
+        return entry
+
+    def prune(self, max_idle=None, prefix="panel_"):
+        """删除超过 max_idle 秒没有重写的数据集 (不同关注池的行情面板按哈希命名，换了关注池旧的就没人用了)"""
+        max_idle = self.max_idle if max_idle is None else max_idle
+        self._last_prune = time.time()
+        removed = 0
+        for name in os.listdir(self.directory):
+            base = os.path.join(self.directory, name)
+            entry = self._manifest(name) if name.startswith(prefix) and os.path.isdir(base) else None
+            if entry is None or time.time() - entry["created"] < max_idle:
+                continue
+            if os.path.exists(os.path.join(self.directory, f"{name}.lock")):
+                continue  # 正在被某个进程重建
+            shutil.rmtree(base, ignore_errors=True)  # Windows 下仍被映射的文件删不掉，下次再清
+            with self._lock:
+                self._opened.pop(name, None)
+            removed += 1
+        return removed
+
+    def _open(self, name, entry):
+        with self._lock:
+            cached = self._opened.get(name)
+            if cached and cached[0] == entry["version"]:
+                return cached[1]
+        with metrics.span("shared_cache.open", dataset=name):
+            for _ in range(3):
+                folder = os.path.join(self.directory, name, entry["version"])
+                try:
+                    frames = {key: self._load(folder, key, meta) for key, meta in entry["frames"].items()}
+                    break
+                except FileNotFoundError:
+                    # 读 manifest 之后连续发生了两次写入，这个版本已被清理：换最新版本重试
+                    entry = self._manifest(name) or entry
+            else:
+                raise FileNotFoundError(f"shared cache '{name}' changed while opening")
+        with self._lock:
+            self._opened[name] = (entry["version"], frames)
+        return frames
+
+    def get(self, name, builder, ttl=-1, stamp=None):
+        """取数据集 name ({key: DataFrame})；过期或 stamp 不符时由抢到锁的进程调用 builder() 重建。
+        ttl=-1 使用默认 ttl，ttl=None 表示只看 stamp 不过期"""
+        ttl = self.ttl if ttl == -1 else ttl
+        stamp = None if stamp is None else str(stamp)
+        entry = self._manifest(name)
+        if self._fresh(entry, ttl, stamp):
+            metrics.incr("cache_hit", cache="shared")
+            return self._open(name, entry)
+
+        failure = self._failures.get(name)
+        if failure and time.time() - failure[0] < self.retry_after:
+            metrics.incr("cache_negative_hit", cache="shared")
+            raise failure[1]
+
+        deadline = time.time() + self.wait_timeout
+        while True:
+            if self._acquire(name):
+                try:
+                    # 抢到锁后再看一眼：可能别的进程刚写完
+                    entry = self._manifest(name)
+                    if not self._fresh(entry, ttl, stamp):
+                        metrics.incr("cache_miss", cache="shared")
+                        try:
+                            frames = builder()
+                        except Exception as e:
+                            self._failures[name] = (time.time(), e)
+                            raise
+                        self._failures.pop(name, None)
+                        entry = self._write(name, frames, stamp)
+                finally:
+                    self._release(name)
+                return self._open(name, entry)
+            # 别的进程正在刷新：有旧版本就先用旧的，没有就等它写完
+            if entry is not None and entry.get("stamp") == stamp:
+                metrics.incr("cache_stale", cache="shared")
+                return self._open(name, entry)
+            if time.time() > deadline:
+                raise TimeoutError(f"shared cache '{name}' is locked by another writer")
+            time.sleep(0.2)
+            entry = self._manifest(name)
+            if self._fresh(entry, ttl, stamp):
+                return self._open(name, entry)
+
+    def get_panel(self, tickers, period="1y", ttl=-1):
+        """跨进程共享的 DataEngine.get_price_panel，返回 (close, volume)"""
+        tickers = sorted(set(tickers))
+        name = f"panel_{period}_{hashlib.sha1(','.join(tickers).encode()).hexdigest()[:12]}"
+
+        def build():
+            close, volume = DataEngine.get_price_panel(tickers, period=period)
+            return {"close": close, "volume": volume}
+
+        frames = self.get(name, build, ttl=ttl)
+        return frames["close"], frames["volume"]
+
+    def stats(self):
+        """各数据集的版本、年龄和占用字节数 (调试面板用)"""
+        rows = []
+        for name in sorted(os.listdir(self.directory)):
+            entry = self._manifest(name) if os.path.isdir(os.path.join(self.directory, name)) else None
+            if entry is None:
+                continue
+            folder = os.path.join(self.directory, name, entry["version"])
+            size = sum(os.path.getsize(f) for f in glob.glob(os.path.join(folder, "*.npy")))
+            rows.append({"name": name, "version": entry["version"], "age_s": round(time.time() - entry["created"], 1),
+                         "bytes": size})
+        return rows
+
+
+# ================= 15. 代码宇宙索引 (Symbol Index) =================
+# 从 data/universe/ 下的上市清单 (csv / txt，逗号、竖线、制表符分隔均可) 载入全市场代码：
+#   - 表头自动识别 (Symbol / Ticker / ASX code / 证券代码 ... + Name / Security Name / 证券简称 ...)
+#   - 文件名带 asx / hk / sse / szse 时，裸代码自动补交易所后缀 (例: asx_listed.csv 里的 BHP → BHP.AX)
+#   - 没有清单文件时退回 MarketUniverse 的内置核心池
+# 前缀检索：代码、去后缀代码、名称及名称中每个单词排成有序数组，bisect 定位后顺序扫描；
+# 模糊检索：代码 + 名称的三字母组 (trigram) 倒排索引，按重合度排序，用来纠正拼写错误。
+
+class SymbolIndex:
+    SYMBOL_FIELDS = ("symbol", "ticker", "code", "asx code", "act symbol", "stock code", "证券代码", "代码")
+    NAME_FIELDS = ("name", "company name", "security name", "company", "name of securities", "证券简称", "名称")
+    MARKET_HINTS = (("asx", ".AX"), ("hkex", ".HK"), ("hk", ".HK"), ("szse", ".SZ"), ("sse", ".SS"))
+    SUFFIX_ALIASES = {".SH": ".SS", ".AU": ".AX", ".ASX": ".AX"}
+    EXCHANGE_SUFFIXES = (".HK", ".AX", ".SS", ".SZ", ".L", ".T", ".TO", ".DE", ".PA", ".SI", ".KS")
+    VALID = re.compile(r"^[A-Z0-9^][A-Z0-9\-.=^]{0,19}$")
+
+    def __init__(self, directory="data/universe"):
+        self.directory = directory
+        self.symbols = []   # 规范代码
+        self.names = []
+        self._by_symbol = {}
+        self._symbol_keys = []  # 有序的 (key, id)：代码、去后缀代码
+        self._name_keys = []    # 有序的 (key, id)：名称、名称中的每个单词
+        self._trigrams = {}
+        self._gram_counts = []
+        self.from_files = False
+        self._build(self._load())
+
+    # ---------- 载入 ----------
+    def _load(self):
+        rows = {}
+        files = sorted(glob.glob(os.path.join(self.directory, "*.csv")) + glob.glob(os.path.join(self.directory, "*.txt")))
+        with metrics.span("universe.load", files=len(files)):
+            for path in files:
+                for symbol, name in self._read_listing(path):
+                    rows.setdefault(symbol, name)
+        self.from_files = bool(rows)
+        if not rows:
+            for pool in MarketUniverse.get_market_options().values():
+                for symbol in pool:
+                    rows.setdefault(symbol, symbol)
+        return rows
+
+    def _read_listing(self, path):
+        fname = os.path.basename(path).lower()
+        suffix = next((sfx for hint, sfx in self.MARKET_HINTS if re.search(rf"(^|[^a-z]){hint}([^a-z]|$)", fname)), "")
+        with open(path, "r", encoding="utf-8-sig", errors="replace") as f:
+            lines = f.read().splitlines()
+        # 表头不一定在第一行 (ASX 的导出文件前面有一行说明)
+        for i, line in enumerate(lines[:10]):
+            delim = max(",|\t", key=line.count)
+            header = [h.strip().strip('"').lower() for h in line.split(delim)]
+            s_col = next((header.index(f) for f in self.SYMBOL_FIELDS if f in header), None)
+            if s_col is not None:
+                break
+        else:
+            return
+        n_col = next((header.index(f) for f in self.NAME_FIELDS if f in header), None)
+        for row in csv.reader(lines[i + 1:], delimiter=delim):
+            if len(row) <= s_col:
+                continue
+            symbol = self.normalize(row[s_col], suffix)
+            if symbol and self.VALID.match(symbol):
+                name = row[n_col].strip() if n_col is not None and len(row) > n_col else ""
+                yield symbol, name or symbol
+
+    # ---------- 代码规范化 ----------
+    @classmethod
+    def normalize(cls, raw, default_suffix=""):
+        """用户输入 / 清单代码 → yfinance 代码：700.hk → 0700.HK，600519 → 600519.SS，BRK.B → BRK-B"""
+        s = re.sub(r"\s+", ".", str(raw).strip().upper())
+        if not s:
+            return ""
+        base, dot, sfx = s.rpartition(".")
+        if dot and "." + sfx in cls.SUFFIX_ALIASES:
+            s = base + cls.SUFFIX_ALIASES["." + sfx]
+        base, dot, sfx = s.rpartition(".")
+        if dot and "." + sfx in cls.EXCHANGE_SUFFIXES:
+            if sfx == "HK" and base.isdigit():
+                base = base.lstrip("0").zfill(4)
+            return f"{base}.{sfx}"
+        if dot:  # 美股类别股 BRK.B → BRK-B
+            s = s.replace(".", "-")
+        if s.isdigit():
+            if default_suffix:
+                return f"{s.lstrip('0').zfill(4)}.HK" if default_suffix == ".HK" else s + default_suffix
+            if len(s) == 6:
+                return s + (".SS" if s[0] == "6" else ".SZ" if s[0] in "03" else "")
+            if len(s) <= 5:
+                return f"{s.lstrip('0').zfill(4)}.HK"
+            return s
+        return s + default_suffix if default_suffix and "-" not in s else s
+
+    # ---------- 建索引 ----------
+    @staticmethod
+    def _grams(text):
+        text = "  " + re.sub(r"[\W_]+", " ", text.upper()).strip() + " "
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def _build(self, rows):
+        with metrics.span("universe.index", symbols=len(rows)):
+            symbol_keys, name_keys = [], []
+            for i, (symbol, name) in enumerate(rows.items()):
+                self.symbols.append(symbol)
+                self.names.append(name)
+                self._by_symbol[symbol] = i
+                bare = symbol.split(".")[0]
+                symbol_keys.append((symbol, i))
+                if bare != symbol:
+                    symbol_keys.append((bare, i))
+                upper = name.upper()
+                name_keys.append((upper, i))
+                for word in upper.split()[1:]:
+                    name_keys.append((word, i))
+                grams = self._grams(symbol) | self._grams(name)
+                self._gram_counts.append(len(grams))
+                for g in grams:
+                    self._trigrams.setdefault(g, []).append(i)
+            self._symbol_keys = sorted(symbol_keys)
+            self._name_keys = sorted(name_keys)
+            self._trigrams = {g: np.asarray(ids, dtype=np.int32) for g, ids in self._trigrams.items()}
+            self._gram_counts = np.asarray(self._gram_counts, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.symbols)
+
+    # ---------- 查询 ----------
+    def _entry(self, i, match):
+        symbol = self.symbols[i]
+        return {"symbol": symbol, "name": self.names[i], "market": symbol.rpartition(".")[2] if "." in symbol else "US",
+                "match": match}
+
+    def resolve(self, raw):
+        """在宇宙里就返回规范代码，否则 None"""
+        symbol = self.normalize(raw)
+        return symbol if symbol in self._by_symbol else None
+
+    def validate(self, raw):
+        """添加关注前的校验：只接受索引里有的代码 (没有清单文件时即内置核心池)"""
+        return self.resolve(raw)
+
+    def unverified(self, raw):
+        """没有清单文件、输入不在内置核心池但格式合法时返回规范代码：界面上需要用户明确确认才添加"""
+        if self.from_files or self.resolve(raw):
+            return None
+        symbol = self.normalize(raw)
+        return symbol if self.VALID.match(symbol) else None
+
+    def prefix(self, query, limit=10):
+        """代码前缀优先，其次名称 / 名称单词前缀"""
+        q = query.strip().upper()
+        if not q:
+            return []
+        out, seen = [], set()
+        for keys in (self._symbol_keys, self._name_keys):
+            pos = bisect.bisect_left(keys, (q, -1))
+            while pos < len(keys) and len(out) < limit:
+                key, i = keys[pos]
+                if not key.startswith(q):
+                    break
+                if i not in seen:
+                    seen.add(i)
+                    out.append(i)
+                pos += 1
+        return out
+
+    def fuzzy(self, query, limit=10, min_score=0.5):
+        grams = [g for g in self._grams(query) if g in self._trigrams]
+        if not grams:
+            return []
+        # 倒排表拼起来一次 bincount，得到每个条目命中的 trigram 数
+        hits = np.bincount(np.concatenate([self._trigrams[g] for g in grams]), minlength=len(self.symbols))
+        score = hits / len(self._grams(query))
+        cand = np.flatnonzero(score >= min_score)
+        # 得分 = 查询的 trigram 命中比例；同分时条目越短 (越"专一") 越靠前
+        order = np.lexsort((self._gram_counts[cand], -score[cand]))[:limit]
+        return cand[order].tolist()
+
+    def search(self, query, limit=8):
+        """自动补全：精确代码 → 前缀 (代码 / 名称)；都没有时才走模糊检索 (拼写纠错)"""
+        with metrics.span("universe.search"):
+            results, seen = [], set()
+            exact = self.resolve(query)
+            if exact:
+                results.append(self._entry(self._by_symbol[exact], "exact"))
+                seen.add(self._by_symbol[exact])
+            for i in self.prefix(query, limit):
+                if i not in seen and len(results) < limit:
+                    results.append(self._entry(i, "prefix"))
+                    seen.add(i)
+            if not results:
+                for i in self.fuzzy(query, limit):
+                    if i not in seen and len(results) < limit:
+                        results.append(self._entry(i, "fuzzy"))
+                        seen.add(i)
+            return results
+
+
+# ================= 16. 汇率表 (FX Table) =================
+# 跨市场海选时把股价、市值统一换算成一个币种。汇率落盘到 data/fx.json (每 1 美元兑多少外币)，
+# 过期后用 yfinance 的 USDxxx=X 货币对一次批量下载刷新；没有缓存文件时使用内置的近似汇率兜底。
+
+class FxTable:
+    DEFAULT_RATES = {"USD": 1.0, "HKD": 7.8, "AUD": 1.52, "CNY": 7.2, "EUR": 0.92, "GBP": 0.79, "JPY": 150.0}
+    MINOR_UNITS = {"GBp": ("GBP", 100), "GBX": ("GBP", 100), "ZAc": ("ZAR", 100), "ILA": ("ILS", 100)}
+
+    def __init__(self, path="data/fx.json", max_age_hours=12, retry_after=900):
+        self.path = path
+        self.max_age = max_age_hours * 3600
+        self.retry_after = retry_after  # 刷新失败后这段时间内不再重试，沿用现有汇率
+        self.rates = dict(self.DEFAULT_RATES)
+        self.asof = 0.0  # 0 表示还在用内置汇率
+        self.failed_at = 0.0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                saved = json.load(f)
+            self.rates = dict(self.DEFAULT_RATES, **saved["rates"])
+            self.asof = saved["asof"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return self.rates
+
+    def is_stale(self):
+        if time.time() - self.failed_at < self.retry_after:
+            return False
+        return time.time() - self.asof > self.max_age
+
+    def refresh(self, currencies=None):
+        """一次请求批量刷新 (默认刷新表里已有的全部币种)；返回没取到汇率的币种"""
+        wanted = sorted({c for c in (currencies or self.rates) if c and c != "USD"})
+        pairs = {f"USD{c}=X": c for c in wanted}
+        if not pairs:
+            return []
+        try:
+            with metrics.span("upstream.download", tickers=len(pairs)):
+                raw = UPSTREAM.call("yahoo", yf.download, list(pairs), period="5d", auto_adjust=True,
+                                    group_by="column", progress=False, threads=True)
+            close = raw["Close"]
+        except Exception:
+            self.failed_at = time.time()
+            raise
+        if isinstance(close, pd.Series):
+            close = close.to_frame(next(iter(pairs)))
+        failed = []
+        for pair, ccy in pairs.items():
+            last = close[pair].dropna() if pair in close else pd.Series(dtype=float)
+            if last.empty or last.iloc[-1] <= 0:
+                failed.append(ccy)
+            else:
+                self.rates[ccy] = float(last.iloc[-1])
+        # 只有全部币种都取到才推进 asof；部分失败时保存已取到的汇率，retry_after 之后再重试
+        if failed:
+            self.failed_at = time.time()
+        else:
+            self.asof = time.time()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"asof": self.asof, "rates": self.rates}, f)
+        os.replace(self.path + ".tmp", self.path)
+        return failed
+
+    def rate(self, from_ccy, to_ccy="USD"):
+        """1 单位 from_ccy 折合多少 to_ccy；未知币种返回 NaN (GBp 这类"分"计价的按 1/100 处理)"""
+        from_ccy = from_ccy or "USD"
+        scale = 1.0
+        if from_ccy in self.MINOR_UNITS:
+            from_ccy, div = self.MINOR_UNITS[from_ccy]
+            scale = 1.0 / div
+        if from_ccy not in self.rates or to_ccy not in self.rates:
+            return float("nan")
+        return scale * self.rates[to_ccy] / self.rates[from_ccy]
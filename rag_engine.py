@@ -1,26 +1,51 @@
+import io
 import os
+import re
+import csv
+import json
+import time
+import hashlib
+import argparse
 import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 import pymupdf4llm
+from collections import Counter, OrderedDict
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
 from openai import OpenAI
 import shutil
+from telemetry import metrics
+from jobs import JobCancelled
 
 
 class RagEngine:
-    def __init__(self):
-        # 初始化 Embedding
-        self.embedding_model = HuggingFaceEmbeddings(
-            model_name="BAAI/bge-small-zh-v1.5",
-            model_kwargs={'device': 'cpu'},
-            encode_kwargs={'normalize_embeddings': True}
-        )
-        self.persist_dir = "./chroma_db_temp"
+    def __init__(self, persist_dir="./chroma_db_temp", embedding_model=None):
+        # 初始化 Embedding (可传入已加载的模型，多个实例共用一份)
+        self.embedding_model = embedding_model or RagEngine.load_embedding_model()
+        self.persist_dir = persist_dir
         self.vector_db = None
+        self.financials = None  # 本地抽取的三大报表关键指标
+        self._query_cache = OrderedDict()  # 问答模式：问题 → 向量 (LRU)
+        self._query_lock = threading.Lock()
+        self._clients = {}  # api_key -> OpenAI；引擎经 get_rag_engine 在会话间共享，每个 key 各用各的客户端
+        self._client_lock = threading.Lock()
+        self._db_lock = threading.Lock()
 
-    def process_pdf(self, uploaded_file):
-        """解析 PDF 并入库"""
+    @staticmethod
+    def load_embedding_model():
+        with metrics.span("rag.model_load"):
+            return HuggingFaceEmbeddings(
+                model_name="BAAI/bge-small-zh-v1.5",
+                model_kwargs={'device': 'cpu'},
+                encode_kwargs={'normalize_embeddings': True}
+            )
+
+    def process_pdf(self, uploaded_file, progress_cb=None, batch_size=64):
+        """解析 PDF 并入库；progress_cb(fraction, message) 用于后台任务汇报进度，抛出 JobCancelled 即中止"""
+        progress = progress_cb or (lambda fraction, message="": None)
         with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
             tmp_file.write(uploaded_file.getvalue())
             tmp_path = tmp_file.name
@@ -29,43 +54,104 @@ class RagEngine:
             if os.path.exists(self.persist_dir):
                 shutil.rmtree(self.persist_dir)
 
-            # 解析
-            md_text = pymupdf4llm.to_markdown(tmp_path)
-            # 适当增大分块，保证数据连贯性
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-            chunks = text_splitter.create_documents([md_text])
-
-            self.vector_db = Chroma.from_documents(
-                documents=chunks,
-                embedding=self.embedding_model,
-                persist_directory=self.persist_dir,
-                collection_name="current_report"
-            )
-            return f"✅ 财报已读取，共切分 {len(chunks)} 个关键片段，准备分析..."
+            # 解析 (按页输出，保留页码)
+            progress(0.05, "parse")
+            with metrics.span("rag.parse"):
+                pages = _parse_pages(tmp_path)
+            md_text = "\n\n".join(text for _, text in pages)
+            progress(0.35, "tables")
+            # 本地识别三大报表，后面研报的"财务摘要"直接喂紧凑表格，不再让模型重读原文
+            with metrics.span("rag.tables"):
+                self.financials = FinancialTableExtractor.extract(md_text)
+            # 按标题/表格结构切块，并去掉每页重复的页眉页脚
+            with metrics.span("rag.chunk"):
+                chunks = StructureChunker().split_pages(pages)
+            if not chunks:
+                return "❌ 解析失败: 未提取到文本 (可能是扫描版 PDF)"
+
+            # 分批写入向量库，每批之间汇报进度、响应取消
+            with metrics.span("rag.embed"):
+                self.vector_db = Chroma(
+                    embedding_function=self.embedding_model,
+                    persist_directory=self.persist_dir,
+                    collection_name="current_report"
+                )
+                for start in range(0, len(chunks), batch_size):
+                    progress(0.4 + 0.55 * start / len(chunks), f"embed {start}/{len(chunks)}")
+                    self.vector_db.add_documents(chunks[start:start + batch_size])
+            metrics.incr("rag_chunks", value=len(chunks))
+            with open(os.path.join(self.persist_dir, "financials.json"), "w", encoding="utf-8") as f:
+                json.dump(self.financials, f, ensure_ascii=False)
+            n_metrics = len(self.financials["metrics"])
+            return f"✅ 财报已读取，共切分 {len(chunks)} 个关键片段，识别 {n_metrics} 项报表指标，准备分析..."
+        except JobCancelled:
+            # 取消时不留下写了一半的向量库
+            self.vector_db = None
+            shutil.rmtree(self.persist_dir, ignore_errors=True)
+            raise
         except Exception as e:
+            metrics.incr("errors", source="rag_ingest")
             return f"❌ 解析失败: {str(e)}"
         finally:
             if os.path.exists(tmp_path): os.remove(tmp_path)
 
-    def generate_report(self, api_key, lang="English"):
+    def _ensure_db(self):
+        """向量库 / 报表指标只从磁盘加载一次，之后的研报和问答都复用 (多个会话共用同一实例，加锁避免重复打开)"""
+        with self._db_lock:
+            if not self.vector_db:
+                if not os.path.exists(self.persist_dir):
+                    return False
+                self.vector_db = Chroma(persist_directory=self.persist_dir, embedding_function=self.embedding_model,
+                                        collection_name="current_report")
+            if self.financials is None:
+                path = os.path.join(self.persist_dir, "financials.json")
+                if os.path.exists(path):
+                    with open(path, "r", encoding="utf-8") as f:
+                        self.financials = json.load(f)
+            return True
+
+    def _llm(self, api_key):
+        # 复用同一个客户端 (连接池)，多轮问答不用每次重新握手
+        with self._client_lock:
+            client = self._clients.get(api_key)
+            if client is None:
+                client = self._clients[api_key] = OpenAI(api_key=api_key, base_url="https://api.deepseek.com")
+        return client
+
+    def generate_report(self, api_key, lang="English", progress_cb=None):
         """
         根据语言自动生成标准化研报
         """
-        if not self.vector_db:
-            if os.path.exists(self.persist_dir):
-                self.vector_db = Chroma(persist_directory=self.persist_dir, embedding_function=self.embedding_model,
-                                        collection_name="current_report")
-            else:
-                return "⚠️ Please upload a PDF first. / 请先上传 PDF。"
+        progress = progress_cb or (lambda fraction, message="": None)
+        if not self._ensure_db():
+            return "⚠️ Please upload a PDF first. / 请先上传 PDF。"
 
         # 1. 广域检索
-        search_query = "Financial statements, revenue, net income, profit margin, balance sheet, risk factors, business outlook, management discussion"
-        results = self.vector_db.similarity_search(search_query, k=25)
+        structured = bool(self.financials and self.financials.get("metrics"))
+        if structured:
+            # 数字已经在本地表格里了，检索只需要覆盖经营分析 / 风险 / 展望这些叙述性内容
+            search_query = "Management discussion, drivers of growth or decline, segment performance, risk factors, business outlook, guidance"
+            k = 12
+        else:
+            search_query = "Financial statements, revenue, net income, profit margin, balance sheet, risk factors, business outlook, management discussion"
+            k = 25
+        progress(0.1, "retrieve")
+        with metrics.span("rag.retrieve"):
+            results = self.vector_db.similarity_search(search_query, k=k)
+        if structured:
+            results = [c for c in results if not FinancialTableExtractor.is_table_chunk(c.page_content)]
 
         if not results: return "⚠️ No relevant content found. / 未提取到有效内容。"
 
         # 2. 组装上下文
         context = "\n\n".join([f"---Excerpt {i + 1}---\n{c.page_content}" for i, c in enumerate(results)])
+        if structured:
+            table = FinancialTableExtractor.to_markdown(self.financials)
+            if lang == "English":
+                context = f"---Structured Financial Data (parsed locally, use it for Financial Highlights)---\n{table}\n\n{context}"
+            else:
+                context = f"---结构化财务数据 (本地解析，核心财务摘要请以此为准)---\n{table}\n\n{context}"
+        metrics.incr("llm_prompt_chars", value=len(context))
 
         # 3. 设定双语 Prompt
         if lang == "English":
@@ -100,16 +186,686 @@ class RagEngine:
             user_msg = f"请基于以下财报原文生成研报：\n{context}"
 
         # 调用 DeepSeek
-        client = OpenAI(api_key=api_key, base_url="https://api.deepseek.com")
+        progress(0.3, "llm")
+        client = self._llm(api_key)
         try:
-            response = client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_msg}
-                ],
-                temperature=0.2
-            )
+            with metrics.span("llm.chat", model="deepseek-chat"):
+                response = client.chat.completions.create(
+                    model="deepseek-chat",
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_msg}
+                    ],
+                    temperature=0.2
+                )
             return response.choices[0].message.content
         except Exception as e:
-            return f"❌ API Error: {str(e)}"
\ No newline at end of file
+            metrics.incr("errors", source="llm")
+            return f"❌ API Error: {str(e)}"
+
+    # ---------- 问答模式 (Q&A) ----------
+    QUERY_CACHE_SIZE = 256
+    QA_PROMPTS = {
+        "English": "You are a precise financial analyst answering questions about one company report. "
+                   "Answer only from the excerpts provided in this conversation, each tagged like [S1]. "
+                   "Cite the tags inline after every claim that uses them. "
+                   "If the excerpts do not contain the answer, say it is not disclosed. Be concise.",
+        "中文": "你是一位严谨的金融分析师，正在回答关于一份财报的问题。"
+               "只能依据本次对话中提供的财报片段 (每段带有 [S1] 这样的标签) 作答，"
+               "引用到的内容请在句末标注对应标签；片段中没有的信息请直接说明“未披露”。回答尽量简洁。",
+    }
+
+    def embed_query(self, text):
+        """问题向量带 LRU 缓存：重复或改写后相同的问题不再跑一遍 Embedding 模型"""
+        key = " ".join(text.split()).lower()
+        with self._query_lock:
+            vec = self._query_cache.get(key)
+            if vec is not None:
+                self._query_cache.move_to_end(key)
+                metrics.incr("cache_hit", cache="query_embedding")
+                return vec
+        with metrics.span("rag.embed_query"):
+            vec = self.embedding_model.embed_query(text)
+        with self._query_lock:
+            self._query_cache[key] = vec
+            while len(self._query_cache) > self.QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        return vec
+
+    def retrieve(self, question, k=6):
+        with metrics.span("rag.retrieve", caller="qa"):
+            return self.vector_db.similarity_search_by_vector(self.embed_query(question), k=k)
+
+    def ask(self, question, api_key, session=None, k=6, lang="English"):
+        """
+        针对已入库的财报追问。返回 (citations, stream)：
+        citations 为本轮检索到的片段出处 (标签 / 页码 / 章节)，stream 逐段产出回答文本 (可直接交给 st.write_stream)。
+        session (QaSession) 保存多轮对话的紧凑状态，已经发给模型的片段后续轮次只引用标签、不再重复发送。
+        """
+        session = session if session is not None else QaSession()
+        if not self._ensure_db():
+            return [], iter(["⚠️ Please upload a PDF first. / 请先上传 PDF。"])
+
+        t0 = time.perf_counter()
+        docs = self.retrieve(question, k=k)
+        already_sent = session.sent_ids()
+        citations, blocks, new_ids = [], [], []
+        for doc in docs:
+            chunk_id = doc.id or hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()[:16]
+            source = session.source(chunk_id, doc.metadata)
+            citations.append(source)
+            if chunk_id not in already_sent and chunk_id not in new_ids:
+                blocks.append(f"[{source['label']}] ({QaSession.cite(source)})\n{doc.page_content}")
+                new_ids.append(chunk_id)
+
+        labels = ", ".join(dict.fromkeys(c["label"] for c in citations))
+        prompt = ("New excerpts:\n\n" + "\n\n".join(blocks) + "\n\n" if blocks else "") + \
+                 f"Most relevant excerpts: {labels}\n\nQuestion: {question}"
+        messages = [{"role": "system", "content": self.QA_PROMPTS.get(lang, self.QA_PROMPTS["English"])}] + \
+                   session.messages() + [{"role": "user", "content": prompt}]
+        metrics.incr("llm_prompt_chars", value=len(prompt))
+
+        def stream():
+            parts = []
+            try:
+                with metrics.span("llm.chat", model="deepseek-chat", caller="qa"):
+                    response = self._llm(api_key).chat.completions.create(
+                        model="deepseek-chat", messages=messages, temperature=0.2, stream=True)
+                    for chunk in response:
+                        delta = chunk.choices[0].delta.content if chunk.choices else None
+                        if not delta:
+                            continue
+                        if not parts:
+                            metrics.observe("rag.qa_first_token", time.perf_counter() - t0)
+                        parts.append(delta)
+                        yield delta
+            except Exception as e:
+                metrics.incr("errors", source="llm")
+                parts.append(f"\n\n❌ API Error: {str(e)}")
+                yield parts[-1]
+            session.add(prompt, "".join(parts), new_ids)
+
+        return citations, stream()
+
+
+class QaSession:
+    """问答的紧凑会话状态：只保留最近 max_turns 轮；每个片段只发送一次，按 [S1] [S2] 这样的标签引用"""
+
+    def __init__(self, max_turns=4):
+        self.max_turns = max_turns
+        self.turns = []    # [{"prompt", "answer", "chunk_ids"}]
+        self.sources = {}  # chunk_id → {"label", "page", "page_end", "section"}
+
+    def source(self, chunk_id, metadata):
+        if chunk_id not in self.sources:
+            self.sources[chunk_id] = {"label": f"S{len(self.sources) + 1}", "page": metadata.get("page"),
+                                      "page_end": metadata.get("page_end"), "section": metadata.get("section", "")}
+        return self.sources[chunk_id]
+
+    def sent_ids(self):
+        # 被挤出窗口的轮次里发过的片段，下次命中时会重新发送
+        return {cid for turn in self.turns for cid in turn["chunk_ids"]}
+
+    def messages(self):
+        out = []
+        for turn in self.turns:
+            out.append({"role": "user", "content": turn["prompt"]})
+            out.append({"role": "assistant", "content": turn["answer"]})
+        return out
+
+    def add(self, prompt, answer, chunk_ids):
+        self.turns.append({"prompt": prompt, "answer": answer, "chunk_ids": list(chunk_ids)})
+        self.turns = self.turns[-self.max_turns:]
+
+    @staticmethod
+    def cite(source):
+        page, end = source.get("page"), source.get("page_end")
+        pages = f"p.{page}" if not end or end == page else f"p.{page}-{end}"
+        return f"{pages} · {source['section']}" if source.get("section") else pages
+
+
+# ================= 后台任务入口 (供 JobManager 调用) =================
+def ingest_job(ctx, data, embedding_model=None, root="./chroma_db_jobs"):
+    """入库任务：每个任务独立的向量库目录，多个会话同时上传互不覆盖"""
+    persist_dir = os.path.join(root, ctx.job_id)
+    ctx.add_artifact(persist_dir)  # 任务记录过期清理时连同向量库目录一起删
+    engine = RagEngine(persist_dir=persist_dir, embedding_model=embedding_model)
+    msg = engine.process_pdf(io.BytesIO(data), progress_cb=ctx.progress)
+    if msg.startswith("❌"):
+        raise RuntimeError(msg)
+    return {"message": msg, "persist_dir": persist_dir}
+
+
+def report_job(ctx, persist_dir, api_key, lang="English", embedding_model=None):
+    """研报任务：基于已完成的入库任务目录生成报告"""
+    engine = RagEngine(persist_dir=persist_dir, embedding_model=embedding_model)
+    report = engine.generate_report(api_key, lang=lang, progress_cb=ctx.progress)
+    if report.startswith("❌"):
+        raise RuntimeError(report)
+    return {"report": report}
+
+
+# ================= 结构化切块 (Structure-aware Chunking) =================
+# 取代固定 1000 字符的 RecursiveCharacterTextSplitter：
+#   1. 先找出在大多数页面上重复出现的行 (页眉、页脚、页码、法律声明) 并删除
+#   2. 按 Markdown 标题划分章节，片段不跨章节
+#   3. 表格整体作为一个块，绝不从中间切开
+#   4. 每个片段带上 section / page / page_end 元数据，方便引用出处
+
+class StructureChunker:
+    _HEADING_RE = re.compile(r"^(#{1,6})\s+(.*)")
+    EDGE_LINES = 4  # 页眉/页脚区域：每页首尾各几行
+    MAX_LINE = 200
+
+    def __init__(self, chunk_size=1000, boilerplate_ratio=0.5, min_pages=3):
+        self.chunk_size = chunk_size
+        self.boilerplate_ratio = boilerplate_ratio
+        self.min_pages = min_pages
+        # 超长段落的兜底切分
+        self._fallback = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=100)
+
+    @staticmethod
+    def _normalize(line):
+        """数字统一替换，让 'Page 3 of 120' 与 'Page 4 of 120' 视为同一行"""
+        return re.sub(r"\d+", "#", line.strip().lower())
+
+    @staticmethod
+    def _edge(lines, edge_lines=EDGE_LINES, max_len=MAX_LINE):
+        """页眉/页脚区域的行号：候选行 (非空短行，排除表格行和标题行) 里的前后各 edge_lines 行"""
+        candidates = [i for i, l in enumerate(lines)
+                      if l.strip() and len(l) <= max_len and not l.lstrip().startswith(("|", "#"))]
+        return set(candidates[:edge_lines] + candidates[-edge_lines:])
+
+    def find_boilerplate(self, pages, edge_lines=EDGE_LINES, max_len=MAX_LINE):
+        """
+        每页首尾 edge_lines 行 (页眉/页脚区域) 中，出现在 >= boilerplate_ratio 比例页面上的短行。
+        表格行和标题行不参与判断 (它们是结构，不是页眉页脚)
+        """
+        if len(pages) < self.min_pages:
+            return set()
+        counts = Counter()
+        for _, text in pages:
+            lines = text.splitlines()
+            counts.update({self._normalize(lines[i]) for i in self._edge(lines, edge_lines, max_len)})
+        threshold = max(self.min_pages, self.boilerplate_ratio * len(pages))
+        return {line for line, n in counts.items() if n >= threshold}
+
+    def _blocks(self, pages, boilerplate):
+        """逐行扫描，产出 (类型, 文本, 页码, 章节)；类型为 heading / table / text"""
+        section = []  # [(标题级别, 标题), ...]
+
+        def path():
+            return " > ".join(title for _, title in section)
+
+        for page_no, text in pages:
+            para, table = [], []
+
+            def flush():
+                if para:
+                    yield "text", "\n".join(para), page_no, path()
+                    para.clear()
+                if table:
+                    yield "table", "\n".join(table), page_no, path()
+                    table.clear()
+
+            lines = text.splitlines()
+            # 只在页眉/页脚区域里删：正文里恰好相同的行 (例如只有数字的行) 要保留
+            edge = self._edge(lines) if boilerplate else ()
+            for i, line in enumerate(lines):
+                if i in edge and self._normalize(line) in boilerplate:
+                    continue
+                heading = self._HEADING_RE.match(line.strip())
+                if heading:
+                    yield from flush()
+                    level, title = len(heading.group(1)), re.sub(r"[*_`]", "", heading.group(2)).strip()
+                    while section and section[-1][0] >= level:
+                        section.pop()
+                    section.append((level, title))
+                    yield "heading", line.strip(), page_no, path()
+                elif line.lstrip().startswith("|"):
+                    if para:
+                        yield from flush()
+                    table.append(line)
+                elif not line.strip():
+                    yield from flush()
+                else:
+                    if table:
+                        yield from flush()
+                    para.append(line)
+            yield from flush()
+
+    def split_pages(self, pages):
+        """pages: [(页码, markdown), ...] -> [Document]"""
+        boilerplate = self.find_boilerplate(pages)
+        chunks = []
+        buf, meta = [], None
+
+        def emit():
+            if buf:
+                text = "\n\n".join(buf)
+                if meta["section"] and not buf[0].startswith("#"):
+                    text = f"[{meta['section']}]\n{text}"  # 续写片段补上章节名，检索时更好命中
+                chunks.append(Document(page_content=text, metadata=dict(meta)))
+                buf.clear()
+
+        for kind, text, page_no, section in self._blocks(pages, boilerplate):
+            new_section = kind == "heading" or (meta is not None and section != meta["section"])
+            size = sum(len(b) for b in buf)
+            if buf and (new_section or size + len(text) > self.chunk_size):
+                emit()
+            if not buf:
+                meta = {"section": section, "page": page_no, "page_end": page_no, "has_table": False}
+            if kind == "text" and len(text) > self.chunk_size:
+                # 超长段落单独切开 (表格不走这里，永远整块保留)
+                emit()
+                for piece in self._fallback.split_text(text):
+                    chunks.append(Document(page_content=piece, metadata=dict(meta, page=page_no, page_end=page_no)))
+                meta = None
+                continue
+            buf.append(text)
+            meta["page_end"] = page_no
+            meta["has_table"] = meta["has_table"] or kind == "table"
+        emit()
+        return chunks
+
+
+def benchmark_chunking(pdf_path, embedding_model=None):
+    """
+    对同一份 PDF 比较旧切分器与 StructureChunker：片段数、总字符数、切块耗时，
+    传入 embedding_model 时再比较向量化耗时 (入库的大头)
+    """
+    pages = _parse_pages(pdf_path)
+    md_text = "\n\n".join(text for _, text in pages)
+    report = {"pages": len(pages)}
+
+    t0 = time.perf_counter()
+    old = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200).split_text(md_text)
+    t1 = time.perf_counter()
+    new = [d.page_content for d in StructureChunker().split_pages(pages)]
+    t2 = time.perf_counter()
+    report["baseline"] = {"chunks": len(old), "chars": sum(map(len, old)), "chunk_sec": round(t1 - t0, 4)}
+    report["structure"] = {"chunks": len(new), "chars": sum(map(len, new)), "chunk_sec": round(t2 - t1, 4)}
+
+    if embedding_model is not None:
+        for key, texts in (("baseline", old), ("structure", new)):
+            t = time.perf_counter()
+            embedding_model.embed_documents(texts)
+            report[key]["embed_sec"] = round(time.perf_counter() - t, 2)
+        report["embed_speedup"] = round(report["baseline"]["embed_sec"] / max(report["structure"]["embed_sec"], 1e-9), 2)
+
+    report["chunk_reduction"] = round(1 - len(new) / max(len(old), 1), 3)
+    report["char_reduction"] = round(1 - report["structure"]["chars"] / max(report["baseline"]["chars"], 1), 3)
+    return report
+
+
+# ================= 结构化报表抽取 (Financial Table Extraction) =================
+# pymupdf4llm 会把 PDF 表格转成 Markdown 管道表。这里在本地识别利润表 / 资产负债表 / 现金流量表，
+# 把关键行解析成数值，算好同比和利润率，研报时只需喂一张紧凑的小表。
+
+class FinancialTableExtractor:
+    # 报表类型关键词 (中英文)，命中 >= 2 个才认定
+    STATEMENT_KEYWORDS = {
+        "income": ["revenue", "net sales", "gross profit", "operating income", "net income", "cost of",
+                   "earnings per share", "营业收入", "营业成本", "营业利润", "净利润", "利润总额", "每股收益"],
+        "balance": ["total assets", "total liabilities", "shareholders", "stockholders", "inventories",
+                    "cash and cash equivalents", "资产总计", "负债合计", "所有者权益", "股东权益", "存货"],
+        "cashflow": ["operating activities", "investing activities", "financing activities", "capital expenditure",
+                     "经营活动", "投资活动", "筹资活动", "购建固定资产"],
+    }
+    # 标准指标 -> (所属报表, 行名匹配规则)；按顺序取第一个命中的行
+    METRICS = {
+        "revenue": ("income", r"^(total )?(net )?(revenues?|sales)\b|^total net sales|营业总收入|^营业收入"),
+        "gross_profit": ("income", r"^gross (profit|margin)$|毛利"),
+        "operating_income": ("income", r"^(total )?operating income|income from operations|^营业利润"),
+        "net_income": ("income", r"^net (income|earnings)( attributable.*)?$|^net profit|^净利润|归属于.*股东的净利润"),
+        "total_assets": ("balance", r"^total assets|资产总计|资产合计"),
+        "total_liabilities": ("balance", r"^total liabilities$|负债合计"),
+        "equity": ("balance", r"^total (shareholders|stockholders)['’]? equity|所有者权益合计|股东权益合计"),
+        "cash": ("balance", r"^cash and cash equivalents|货币资金"),
+        "operating_cf": ("cashflow", r"cash (generated|provided) (by|from) operating activities|经营活动产生的现金流量净额"),
+        "capex": ("cashflow", r"(purchases? of|payments for)( the)?( acquisition of)? (property|plant)|capital expenditure|购建固定资产"),
+    }
+    _YEAR_RE = re.compile(r"(?:19|20)\d{2}")
+    _UNIT_RE = re.compile(r"in (thousands|millions|billions)|千元|百万元|万元|亿元", re.IGNORECASE)
+
+    @staticmethod
+    def parse_number(cell):
+        """'1,234.5' -> 1234.5；'(12)' -> -12；'—' / '' -> None"""
+        text = re.sub(r"[\s$¥€£,*]|HK\$|RMB|US\$", "", cell or "")
+        text = text.replace("%", "")
+        if not text or text in {"-", "—", "–", "N/A", "n/a"}:
+            return None
+        neg = text.startswith("(") and text.endswith(")")
+        text = text.strip("()")
+        try:
+            value = float(text)
+        except ValueError:
+            return None
+        return -value if neg else value
+
+    @staticmethod
+    def _split_row(line):
+        return [c.strip() for c in line.strip().strip("|").split("|")]
+
+    @staticmethod
+    def find_tables(md_text):
+        """返回 [(上文若干行, [行单元格列表...]), ...]"""
+        tables, current, context = [], [], []
+        for line in md_text.splitlines():
+            if line.lstrip().startswith("|"):
+                if re.fullmatch(r"[\s|:\-]+", line):  # 分隔行 |---|---|
+                    continue
+                current.append(FinancialTableExtractor._split_row(line))
+            else:
+                if current:
+                    tables.append((" ".join(context[-3:]), current))
+                    current = []
+                if line.strip():
+                    context.append(line.strip())
+        if current:
+            tables.append((" ".join(context[-3:]), current))
+        return tables
+
+    @staticmethod
+    def classify(context, rows):
+        text = (context + " " + " ".join(r[0] for r in rows if r)).lower()
+        scores = {k: sum(kw in text for kw in kws) for k, kws in FinancialTableExtractor.STATEMENT_KEYWORDS.items()}
+        best = max(scores, key=scores.get)
+        return best if scores[best] >= 2 else None
+
+    @staticmethod
+    def _periods(rows):
+        """
+        找出表头里的期间列 (带年份的列)，按年份从新到旧排序：[(列号, 期间名), ...]。
+        季报常见 "Three Months 2024 | Three Months 2023 | Nine Months 2024 | Nine Months 2023"：
+        优先取和第一个期间列同口径 (去掉年份后的列名相同) 的列，保证当期 / 上期是 3 个月对 3 个月；
+        同口径凑不出两年时 (资产负债表 "September 2024 | December 2023") 退回全部期间列。
+        同一年份只保留表头里靠前的那列
+        """
+        YEAR_RE = FinancialTableExtractor._YEAR_RE
+        for header in rows[:3]:
+            cols = [(i, YEAR_RE.search(c).group(0), re.sub(r"\W+", " ", YEAR_RE.sub("", c)).strip().lower())
+                    for i, c in enumerate(header) if i > 0 and YEAR_RE.search(c)]
+            if len(cols) < 2:
+                continue
+            for basis in (cols[0][2], None):
+                picked = {}
+                for i, year, label in cols:
+                    if basis in (None, label) and year not in picked:
+                        picked[year] = i
+                if len(picked) >= 2:
+                    return sorted(((i, year) for year, i in picked.items()), key=lambda x: x[1], reverse=True)
+        return []
+
+    @staticmethod
+    def extract(md_text):
+        """
+        返回 {"unit": 单位, "periods": [最新, 上期], "metrics": {指标: {"current", "prior", "yoy", "periods"}},
+              "ratios": {...}}
+        每个指标带上它所在表格的期间；顶层 periods 取第一个命中指标的期间 (表头用)
+        """
+        FTE = FinancialTableExtractor
+        found = {}  # 指标 -> (当期, 上期, [当期名, 上期名])
+        periods, unit = [], ""
+        for context, rows in FTE.find_tables(md_text):
+            statement = FTE.classify(context, rows)
+            cols = FTE._periods(rows)
+            if not statement or len(cols) < 2:
+                continue
+            (c_cur, p_cur), (c_pri, p_pri) = cols[0], cols[1]
+            unit_match = FTE._UNIT_RE.search(context + " " + " ".join(" ".join(r) for r in rows[:2]))
+            for row in rows:
+                if not row or len(row) <= max(c_cur, c_pri):
+                    continue
+                label = re.sub(r"\*|\s+", " ", row[0]).strip().lower()
+                for name, (stmt, pattern) in FTE.METRICS.items():
+                    if name in found or stmt != statement or not re.search(pattern, label):
+                        continue
+                    cur, pri = FTE.parse_number(row[c_cur]), FTE.parse_number(row[c_pri])
+                    if cur is not None:
+                        found[name] = (cur, pri, [p_cur, p_pri])
+                        if not periods:
+                            periods = [p_cur, p_pri]
+                        if unit_match and not unit:
+                            unit = unit_match.group(0)
+
+        result = {"unit": unit, "periods": periods, "metrics": {}, "ratios": {}}
+        for name, (cur, pri, when) in found.items():
+            yoy = (cur - pri) / abs(pri) if pri not in (None, 0) else None
+            result["metrics"][name] = {"current": cur, "prior": pri, "yoy": yoy, "periods": when}
+
+        # 比率只在两个指标来自同一期间时计算，避免拿季度利润除以年度收入
+        m = {k: v["current"] for k, v in result["metrics"].items()}
+        when = {k: v["periods"] for k, v in result["metrics"].items()}
+
+        def same(a, b):
+            return a in m and b in m and when[a] == when[b]
+
+        rev = m.get("revenue")
+        if rev:
+            for key, item in (("gross_margin", "gross_profit"), ("operating_margin", "operating_income"),
+                              ("net_margin", "net_income")):
+                if same(item, "revenue"):
+                    result["ratios"][key] = m[item] / rev
+        if m.get("total_assets") and same("total_liabilities", "total_assets"):
+            result["ratios"]["debt_ratio"] = m["total_liabilities"] / m["total_assets"]
+        if same("operating_cf", "capex"):
+            result["ratios"]["free_cash_flow"] = m["operating_cf"] - abs(m["capex"])
+        return result
+
+    @staticmethod
+    def to_markdown(financials):
+        """紧凑表格：指标 | 当期 | 上期 | 同比，外加利润率"""
+        cur, pri = (financials.get("periods") or ["Current", "Prior"])[:2]
+        lines = [f"Unit: {financials.get('unit') or 'as reported'}",
+                 f"| Metric | {cur} | {pri} | YoY |", "|---|---|---|---|"]
+        for name, v in financials["metrics"].items():
+            yoy = f"{v['yoy']:+.1%}" if v["yoy"] is not None else "-"
+            prior = f"{v['prior']:,.0f}" if v["prior"] is not None else "-"
+            when = v.get("periods")
+            if when and when != [cur, pri]:
+                name = f"{name} ({when[0]} vs {when[1]})"  # 出自期间不同的表格，单独标明
+            lines.append(f"| {name} | {v['current']:,.0f} | {prior} | {yoy} |")
+        for name, v in financials.get("ratios", {}).items():
+            lines.append(f"| {name} | {v:.1%} | | |" if name != "free_cash_flow" else f"| {name} | {v:,.0f} | | |")
+        return "\n".join(lines)
+
+    @staticmethod
+    def is_table_chunk(text):
+        """超过一半行是表格行的片段 (数字已在结构化表里，研报时不再重复喂给模型)"""
+        lines = [l for l in text.splitlines() if l.strip()]
+        return bool(lines) and sum(l.lstrip().startswith("|") for l in lines) / len(lines) > 0.5
+
+
+# ================= 批量入库 (Bulk Corpus Ingestion) =================
+# 把一个目录 (或清单文件) 里的历年 10-K / 10-Q / 年报一次性建好索引：
+#   - 解析 (CPU 密集) 放进进程池并行；切块 + 向量化 + 写库在主进程串行 (Chroma 单写者)
+#   - 每个文件按内容哈希登记到 ledger，崩溃后重跑会跳过已完成的文件
+#   - 分块 id = 哈希:序号，重跑同一文件是 upsert，不会产生重复片段
+
+# 文件名里的代码 / 期间识别，例如 "AAPL_10-K_2023.pdf"、"0700.HK 2024 Interim Report.pdf"
+_SUFFIXED_RE = re.compile(r"(?<![A-Za-z0-9])(\d{4,6}\.(?:HK|SS|SZ)|[A-Z]{2,4}\.AX)(?![A-Za-z0-9])")
+_TICKER_RE = re.compile(r"(?<![A-Za-z0-9])([A-Z]{1,5}(?:-[A-Z])?)(?![A-Za-z0-9])")
+_PERIOD_RE = re.compile(r"(?<![\d.])(?:FY)?((?:19|20)\d{2})(?![\d.])(?:[\s_-]*(Q[1-4]|H[12]))?", re.IGNORECASE)
+_DOCTYPE_RE = re.compile(r"10-?K|10-?Q|20-?F|annual|interim|quarterly", re.IGNORECASE)
+
+
+def infer_metadata(path):
+    """从文件名推断 ticker / period / doc_type，识别不出的字段留空"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    doc = _DOCTYPE_RE.search(name)
+    # 带交易所后缀的代码优先；否则去掉 10-K / 2023 之类再找纯字母代码
+    ticker = _SUFFIXED_RE.search(name) or _TICKER_RE.search(_PERIOD_RE.sub(" ", _DOCTYPE_RE.sub(" ", name)))
+    period = _PERIOD_RE.search(_SUFFIXED_RE.sub(" ", name))
+    return {
+        "ticker": ticker.group(1) if ticker else "",
+        "period": (period.group(1) + (period.group(2) or "").upper()) if period else "",
+        "doc_type": doc.group(0).upper().replace("-", "") if doc else "",
+    }
+
+
+def _file_digest(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _parse_pages(path):
+    """进程池里执行：返回 [(页码, markdown), ...]"""
+    pages = pymupdf4llm.to_markdown(path, page_chunks=True)
+    return [(p.get("metadata", {}).get("page", i + 1), p.get("text", "")) for i, p in enumerate(pages)]
+
+
+class BatchIngestor:
+    def __init__(self, engine, persist_dir="./chroma_db_corpus", collection_name="corpus", workers=4):
+        self.engine = engine
+        self.persist_dir = persist_dir
+        self.collection_name = collection_name
+        self.workers = workers
+        self.ledger_path = os.path.join(persist_dir, "ingest_ledger.json")
+        self.ledger = self._load_ledger()
+        self.vector_db = Chroma(persist_directory=persist_dir, embedding_function=engine.embedding_model,
+                                collection_name=collection_name)
+
+    def _load_ledger(self):
+        if os.path.exists(self.ledger_path):
+            with open(self.ledger_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return {}
+
+    def _save_ledger(self):
+        os.makedirs(self.persist_dir, exist_ok=True)
+        tmp = self.ledger_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.ledger, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.ledger_path)
+
+    @staticmethod
+    def discover(source):
+        """
+        source 可以是目录 (递归找 *.pdf) 或清单文件：
+            .csv  —— 列 path[,ticker,period,doc_type]
+            .json / .jsonl —— 同名字段的对象列表
+        清单里的相对路径相对清单所在目录；没写的字段从文件名推断。
+        """
+        if os.path.isdir(source):
+            paths = sorted(os.path.join(root, f) for root, _, files in os.walk(source)
+                           for f in files if f.lower().endswith(".pdf"))
+            return [dict(infer_metadata(p), path=p) for p in paths]
+
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source, "r", encoding="utf-8") as f:
+            if source.endswith(".csv"):
+                rows = list(csv.DictReader(f))
+            elif source.endswith(".jsonl"):
+                rows = [json.loads(line) for line in f if line.strip()]
+            else:
+                rows = json.load(f)
+        items = []
+        for row in rows:
+            path = row["path"] if os.path.isabs(row["path"]) else os.path.join(base, row["path"])
+            meta = infer_metadata(path)
+            meta.update({k: row[k] for k in ("ticker", "period", "doc_type") if row.get(k)})
+            items.append(dict(meta, path=path))
+        return items
+
+    def _index(self, item, digest, pages):
+        """切块 + 向量化 + 写库 (主进程)"""
+        texts, metas = [], []
+        with metrics.span("rag.chunk"):
+            for doc in StructureChunker().split_pages(pages):
+                texts.append(doc.page_content)
+                metas.append(dict(doc.metadata, source=os.path.basename(item["path"]), doc_id=digest,
+                                  ticker=item["ticker"], period=item["period"], doc_type=item["doc_type"]))
+        if texts:
+            with metrics.span("rag.embed"):
+                self.vector_db.add_texts(texts, metadatas=metas, ids=[f"{digest}:{i}" for i in range(len(texts))])
+        return len(texts)
+
+    def _drop_previous(self, path, digest):
+        """同一路径的文件内容变了：删掉旧版本的块和台账记录，避免新旧两版同时被检索到"""
+        for old, record in list(self.ledger.items()):
+            if old != digest and record.get("path") == path:
+                self.vector_db.delete(where={"doc_id": old})
+                del self.ledger[old]
+
+    def run(self, source, progress_cb=None):
+        """执行批量入库，返回吞吐统计；progress_cb(done, total, item) 可用于进度条"""
+        items = self.discover(source)
+        todo, skipped = [], 0
+        for item in items:
+            digest = _file_digest(item["path"])
+            if self.ledger.get(digest, {}).get("status") == "done":
+                skipped += 1
+                continue
+            todo.append((item, digest))
+
+        stats = {"files": len(items), "skipped": skipped, "indexed": 0, "failed": 0, "pages": 0, "chunks": 0}
+        t0 = time.perf_counter()
+        pending, done = iter(todo), 0
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            # 在途任务最多 2×workers 个，解析结果取走后立即丢掉，内存占用不随文件数增长
+            futures = {}
+            for item, digest in pending:
+                futures[pool.submit(_parse_pages, item["path"])] = (item, digest)
+                if len(futures) >= 2 * self.workers:
+                    break
+            while futures:
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    item, digest = futures.pop(fut)
+                    record = {"path": item["path"], "ticker": item["ticker"], "period": item["period"],
+                              "doc_type": item["doc_type"], "ts": time.time()}
+                    try:
+                        pages = fut.result()
+                        self._drop_previous(item["path"], digest)
+                        n_chunks = self._index(item, digest, pages)
+                        record.update(status="done", pages=len(pages), chunks=n_chunks)
+                        stats["indexed"] += 1
+                        stats["pages"] += len(pages)
+                        stats["chunks"] += n_chunks
+                        metrics.incr("rag_pages", value=len(pages))
+                    except Exception as e:
+                        metrics.incr("errors", source="rag_batch")
+                        record.update(status="failed", error=str(e))
+                        stats["failed"] += 1
+                    # 每完成一个文件就落盘，崩溃后从这里继续
+                    self.ledger[digest] = record
+                    self._save_ledger()
+                    done += 1
+                    if progress_cb:
+                        progress_cb(done, len(todo), item)
+                    nxt = next(pending, None)
+                    if nxt is not None:
+                        futures[pool.submit(_parse_pages, nxt[0]["path"])] = nxt
+
+        elapsed = time.perf_counter() - t0
+        stats["seconds"] = round(elapsed, 2)
+        stats["pages_per_sec"] = round(stats["pages"] / elapsed, 2) if elapsed > 0 else 0.0
+        return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RagEngine utilities")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_ingest = sub.add_parser("ingest", help="批量入库一个目录或清单文件")
+    p_ingest.add_argument("source")
+    p_ingest.add_argument("--workers", type=int, default=4)
+    p_ingest.add_argument("--persist-dir", default="./chroma_db_corpus")
+    p_bench = sub.add_parser("bench-chunk", help="对比旧切分器与结构化切分器")
+    p_bench.add_argument("pdf", nargs="+")
+    p_bench.add_argument("--embed", action="store_true", help="同时测量向量化耗时")
+    args = parser.parse_args()
+
+    if args.cmd == "ingest":
+        ingestor = BatchIngestor(RagEngine(), persist_dir=args.persist_dir, workers=args.workers)
+        result = ingestor.run(args.source, progress_cb=lambda d, n, it: print(f"[{d}/{n}] {it['path']}"))
+        print(json.dumps(result, indent=2))
+    elif args.cmd == "bench-chunk":
+        model = RagEngine.load_embedding_model() if args.embed else None
+        for path in args.pdf:
+            print(path)
+            print(json.dumps(benchmark_chunking(path, model), indent=2))
+
@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+
+# ================= 热路径埋点 (Hot-path Instrumentation) =================
+# 计时 span + 计数器，可导出 Prometheus 文本 / JSON Lines。
+# 默认关闭：关闭时 span() 返回一个共享的空上下文，开销只有一次属性判断。
+# 开启方式：环境变量 QUANT_METRICS=1 (进程级汇总 + 导出)，或在运行时设置 metrics.enabled = True。
+# 调试面板只对单个会话生效：begin_render(trace=True) 只记录本轮渲染的 span，不打开进程级汇总。
+# 本轮渲染的记录放在按 render id 索引的共享收集器里；提交到线程池 / 后台线程的函数用 metrics.bind()
+# 包一层，把 render id 带到工作线程，抓取池、后台刷新、后台任务的耗时也能算进这一轮。
+
+# 直方图分桶 (秒)：覆盖从缓存命中 (~ms) 到 LLM 调用 (~分钟)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class _NullSpan:
+    """关闭状态下的空 span (单例，零分配)"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("registry", "name", "labels", "start")
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        self.registry.observe(self.name, elapsed, error=exc_type is not None, **self.labels)
+        return False
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(label_key, extra=None):
+    pairs = list(label_key) + (list(extra) if extra else [])
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{_escape(v)}"' for k, v in pairs)
+    return "{" + body + "}"
+
+
+class MetricsRegistry:
+    def __init__(self, enabled=None, prefix="quant"):
+        if enabled is None:
+            enabled = os.environ.get("QUANT_METRICS", "0") == "1"
+        self.enabled = enabled
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._spans = {}  # (name, labels) -> {"count", "sum", "max", "errors", "buckets"}
+        self._renders = OrderedDict()  # render id -> [记录]，只保留最近 MAX_RENDERS 轮
+        self._local = threading.local()  # 当前线程归属的 render id
+
+    MAX_RENDERS = 64
+
+    # ---------- 采集接口 ----------
+    def _active(self):
+        return self.enabled or getattr(self._local, "render", None) is not None
+
+    def _record(self, record):
+        render = getattr(self._local, "render", None)
+        if render is None:
+            return
+        with self._lock:
+            records = self._renders.get(render)
+            if records is not None:
+                records.append(record)
+
+    def span(self, name, **labels):
+        """计时上下文：with metrics.span("upstream.info", host="yahoo"): ..."""
+        if not self._active():
+            return _NULL_SPAN
+        return _Span(self, name, labels)
+
+    def timed(self, name, **labels):
+        """函数装饰器版本的 span"""
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self._active():
+                    return fn(*args, **kwargs)
+                with _Span(self, name, labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def incr(self, name, value=1, **labels):
+        """计数器累加 (错误数、缓存命中数等)"""
+        if not self._active():
+            return
+        if self.enabled:
+            key = (name, _label_key(labels))
+            with self._lock:
+                self._counters[key] = self._counters.get(key, 0) + value
+        self._record({"type": "counter", "name": name, "labels": labels, "value": value})
+
+    def observe(self, name, seconds, error=False, **labels):
+        if not self._active():
+            return
+        if self.enabled:
+            self._aggregate(name, seconds, error, labels)
+        self._record({"type": "span", "name": name, "labels": labels, "seconds": seconds, "error": error})
+
+    def _aggregate(self, name, seconds, error, labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            stat = self._spans.get(key)
+            if stat is None:
+                stat = {"count": 0, "sum": 0.0, "max": 0.0, "errors": 0, "buckets": [0] * len(LATENCY_BUCKETS)}
+                self._spans[key] = stat
+            stat["count"] += 1
+            stat["sum"] += seconds
+            stat["max"] = max(stat["max"], seconds)
+            if error:
+                stat["errors"] += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stat["buckets"][i] += 1
+
+    # ---------- 单次渲染明细 (Debug Panel) ----------
+    def begin_render(self, trace=None):
+        """在脚本每次重跑开头调用，开始记录本轮渲染；trace 默认跟随 enabled，
+        trace=True 时即使进程级采集关闭也记录本会话的这一轮"""
+        if not (self.enabled if trace is None else trace):
+            self._local.render = None
+            return
+        render = uuid.uuid4().hex
+        with self._lock:
+            self._renders[render] = []
+            while len(self._renders) > self.MAX_RENDERS:
+                self._renders.popitem(last=False)
+        self._local.render = render
+
+    def context(self):
+        """当前线程归属的 render id (没有在记录时为 None)"""
+        return getattr(self._local, "render", None)
+
+    @contextmanager
+    def attach(self, render):
+        """在工作线程里把记录归到 render 这一轮，退出时恢复"""
+        previous = getattr(self._local, "render", None)
+        self._local.render = render
+        try:
+            yield
+        finally:
+            self._local.render = previous
+
+    def bind(self, fn):
+        """包装要交给线程池 / 后台线程执行的函数，让它的 span 记到提交时的那一轮渲染"""
+        render = self.context()
+        if render is None:
+            return fn
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.attach(render):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def render_breakdown(self):
+        """按 span 名聚合本轮渲染 (含交给工作线程的部分)：次数 / 总耗时 / 最大耗时 / 错误数"""
+        with self._lock:
+            records = list(self._renders.get(self.context(), ()))
+        rows = {}
+        for r in records:
+            label = ",".join(f"{k}={v}" for k, v in sorted(r["labels"].items()))
+            key = (r["type"], r["name"], label)
+            row = rows.setdefault(key, {"type": r["type"], "name": r["name"], "labels": label,
+                                        "count": 0, "total_ms": 0.0, "max_ms": 0.0, "errors": 0})
+            if r["type"] == "span":
+                ms = r["seconds"] * 1000
+                row["count"] += 1
+                row["total_ms"] = round(row["total_ms"] + ms, 2)
+                row["max_ms"] = round(max(row["max_ms"], ms), 2)
+                row["errors"] += int(r["error"])
+            else:
+                row["count"] += r["value"]
+        return sorted(rows.values(), key=lambda x: -x["total_ms"])
+
+    # ---------- 导出 ----------
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._spans.clear()
+
+    def to_prometheus(self):
+        """Prometheus text exposition format"""
+        p = self.prefix
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            spans = {k: dict(v, buckets=list(v["buckets"])) for k, v in self._spans.items()}
+
+        for name in sorted({n for n, _ in counters}):
+            metric = f"{p}_{name.replace('.', '_')}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for (n, lk), v in counters.items():
+                if n == name:
+                    lines.append(f"{metric}{_fmt_labels(lk)} {v}")
+
+        if spans:
+            metric = f"{p}_span_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for (name, lk), s in sorted(spans.items()):
+                base = (("span", name),) + lk
+                for bound, n in zip(LATENCY_BUCKETS, s["buckets"]):
+                    lines.append(f"{metric}_bucket{_fmt_labels(base, [('le', bound)])} {n}")
+                lines.append(f"{metric}_bucket{_fmt_labels(base, [('le', '+Inf')])} {s['count']}")
+                lines.append(f"{metric}_sum{_fmt_labels(base)} {s['sum']:.6f}")
+                lines.append(f"{metric}_count{_fmt_labels(base)} {s['count']}")
+            lines.append(f"# TYPE {p}_span_errors_total counter")
+            for (name, lk), s in sorted(spans.items()):
+                lines.append(f"{p}_span_errors_total{_fmt_labels((('span', name),) + lk)} {s['errors']}")
+        return "\n".join(lines) + "\n"
+
+    def to_jsonl(self):
+        """每个指标一行 JSON，方便落盘或丢给日志系统"""
+        ts = time.time()
+        out = []
+        with self._lock:
+            for (name, lk), v in self._counters.items():
+                out.append({"ts": ts, "type": "counter", "name": name, "labels": dict(lk), "value": v})
+            for (name, lk), s in self._spans.items():
+                out.append({"ts": ts, "type": "span", "name": name, "labels": dict(lk),
+                            "count": s["count"], "sum_s": round(s["sum"], 6), "max_s": round(s["max"], 6),
+                            "errors": s["errors"]})
+        return "\n".join(json.dumps(r, ensure_ascii=False) for r in out) + ("\n" if out else "")
+
+
+# 进程级单例
+metrics = MetricsRegistry()
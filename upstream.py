@@ -0,0 +1,198 @@
+import time
+import random
+import threading
+from telemetry import metrics
+
+
+# ================= 上游访问层 (Upstream Client) =================
+# 所有对 Yahoo 等数据源的调用统一从这里走：
+#   1. 令牌桶限速 (Token Bucket)      —— 平滑请求速率，避免瞬时洪峰
+#   2. 指数退避 + 抖动重试 (Backoff)    —— 只重试限流/网络类错误
+#   3. 按 host 熔断 (Circuit Breaker) —— 连续失败后快速失败，给上游冷却时间
+#   4. 自适应并发 (AIMD)               —— 成功时缓慢加并发，遇到 429 立刻减半
+
+class UpstreamError(Exception):
+    """上游调用失败的基类"""
+
+
+class CircuitOpenError(UpstreamError):
+    """熔断器处于打开状态，调用被直接拒绝"""
+
+
+def is_rate_limited(exc):
+    """识别限流错误 (yfinance 的 YFRateLimitError / HTTP 429)"""
+    text = f"{type(exc).__name__} {exc}"
+    return "RateLimit" in text or "429" in text or "Too Many Requests" in text
+
+
+def is_retryable(exc):
+    """限流与网络类错误可以重试；数据错误 (如无效代码) 重试也没用"""
+    if is_rate_limited(exc):
+        return True
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    name = type(exc).__name__
+    return "Timeout" in name or "Connection" in name
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)  # 每秒补充的令牌数
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取一个令牌，不够时阻塞等待"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """CLOSED -> (连续失败) -> OPEN -> (冷却结束) -> HALF_OPEN -> (试探成功) -> CLOSED"""
+
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "CLOSED"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "CLOSED":
+                return True
+            if self.state == "OPEN" and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = "HALF_OPEN"
+                self._probing = False
+            if self.state == "HALF_OPEN" and not self._probing:
+                self._probing = True  # 半开状态只放行一个试探请求
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "CLOSED"
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == "HALF_OPEN" or self._failures >= self.failure_threshold:
+                self.state = "OPEN"
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+class AdaptiveLimiter:
+    """AIMD 并发控制：每次成功 +1/limit (约每轮 +1)，每次限流 ×0.5"""
+
+    def __init__(self, initial=4, min_limit=1, max_limit=16):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(initial)
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while self._in_flight >= int(self.limit):
+                self._cond.wait()
+            self._in_flight += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+        return False
+
+    def on_success(self):
+        with self._cond:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def on_throttle(self):
+        with self._cond:
+            self.limit = max(self.min_limit, self.limit * 0.5)
+
+
+class _HostState:
+    def __init__(self, rate, burst, max_concurrency):
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker()
+        self.limiter = AdaptiveLimiter(initial=min(4, max_concurrency), max_limit=max_concurrency)
+
+
+class UpstreamClient:
+    def __init__(self, rate=4.0, burst=8, max_concurrency=16, max_retries=4, base_delay=0.5, max_delay=20.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _state(self, host):
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = _HostState(self.rate, self.burst, self.max_concurrency)
+            return self._hosts[host]
+
+    def _backoff(self, attempt):
+        # Full Jitter：sleep = random(0, min(cap, base * 2^attempt))
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def call(self, host, fn, *args, **kwargs):
+        """经过限速 / 熔断 / 自适应并发 / 重试后调用 fn"""
+        state = self._state(host)
+        for attempt in range(self.max_retries + 1):
+            if not state.breaker.allow():
+                metrics.incr("upstream_rejected", host=host)
+                raise CircuitOpenError(f"{host} circuit open")
+
+            state.bucket.acquire()
+            try:
+                with state.limiter, metrics.span("upstream.call", host=host):
+                    result = fn(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    # 数据类错误说明上游是通的，不计入熔断
+                    state.breaker.record_success()
+                    raise
+                if is_rate_limited(e):
+                    metrics.incr("upstream_throttled", host=host)
+                    state.limiter.on_throttle()
+                state.breaker.record_failure()
+                if attempt == self.max_retries:
+                    raise
+                metrics.incr("upstream_retries", host=host)
+                time.sleep(self._backoff(attempt))
+                continue
+
+            state.limiter.on_success()
+            state.breaker.record_success()
+            return result
+
+    def status(self, host):
+        """当前限流/熔断状态，供界面展示"""
+        state = self._state(host)
+        return {"breaker": state.breaker.state, "concurrency": round(state.limiter.limit, 2)}
+
+
+# 进程级共享客户端
+UPSTREAM = UpstreamClient()